@@ -1,58 +1,150 @@
 import sys
-import numpy
+import os
+import time
+import argparse
+import mmap
+import json
+import struct
+import shutil
+import tempfile
+from bisect import bisect_right
+from array import array
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+intern = sys.intern
+
+
+class Program:
+    """
+    Compact, pre-classified representation of an assembly program.
+    Every command is lexed once into parallel arrays (kind, symbol, dest, comp, jump, source line)
+    that both passes of the assembler iterate over. Whitespace and comment lines are not stored
+    """
+    # kind codes held in the kinds array
+    A = 0
+    C = 1
+    L = 2
+
+    def __init__(self):
+        self.kinds = array('B')
+        # 1-based line number of each command in the source
+        self.lines = array('I')
+        self.symbols = []
+        self.dests = []
+        self.comps = []
+        self.jumps = []
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def append(self, record, line_number):
+        """
+        Appends a lexed record (kind, symbol, dest, comp, jump) found at the given source line
+
+        :param record: tuple returned by Parser.lex_line
+        :param line_number: 1-based line number in the source
+        :return:
+        """
+        kind, symbol, dest, comp, jump = record
+        self.kinds.append(kind)
+        self.lines.append(line_number)
+        self.symbols.append(symbol)
+        self.dests.append(dest)
+        self.comps.append(comp)
+        self.jumps.append(jump)
 
 
 class Parser:
     """
     Encapsulates access to the input code.
     Read and assembly language command, parses it and provides convenient access to the command's components(fields and symbols)
+    The whole input is lexed once into a Program; the command accessors read from it
     """
     # class constants
     A_COMMAND = "a_instruction"
     C_COMMAND = "c_instruction"
     L_COMMAND = "label_instruction"
     IGNORE = "ignore"
+    # command type for each Program kind code
+    KINDS = (A_COMMAND, C_COMMAND, L_COMMAND)
 
     def __init__(self, file_name):
         """
         Opens the input file/stream for parsing
         """
-        self._lines = list()
         self._current_inst = 0
         with open(file_name, 'r') as f:
-            self._lines = f.readlines()
-        self._line = self._lines[self._current_inst].strip()
+            self.program = Parser.lex(f)
 
-    def command_type(self):
+    @staticmethod
+    def lex(lines):
+        """
+        Lexes every line of the input exactly once
+
+        :param lines: iterable of source lines
+        :return:
+        Returns the Program holding one record per A/C/L command
+        """
+        program = Program()
+        lex_line = Parser.lex_line
+        for line_number, line in enumerate(lines, 1):
+            record = lex_line(line)
+            if record is not None:
+                program.append(record, line_number)
+        return program
+
+    @staticmethod
+    def lex_line(line):
         """
         A_COMMAND for @xxx instruction
         L_COMMAND for (xxx) label
         C_COMMAND for dest=comp;jump
         Ignore incase of whitespaces or comments (//)
 
+        :param line: source line
         :return:
-        Returns type of current command
+        Returns a (kind, symbol, dest, comp, jump) record, None if the line is to be ignored
+        """
+        c_index = line.find('//')
+        if c_index != -1:
+            line = line[:c_index]
+        line = line.strip()
+        if not line:
+            return None
+        a_index = line.find('@')
+        if a_index != -1:
+            return Program.A, intern(line[a_index + 1:].strip()), None, None, None
+        l_o_index = line.find('(')
+        l_c_index = line.find(')')
+        if l_o_index != -1 and l_o_index < l_c_index:
+            return Program.L, intern(line[l_o_index + 1:l_c_index].strip()), None, None, None
+        # C instruction, whitespace is not significant (D = D+1 ; JGT)
+        line = ''.join(line.split())
+        index_e = line.find('=')
+        index_j = line.find(';')
+        dest = intern(line[:index_e]) if index_e != -1 else None
+        if index_j == -1:
+            comp = line[index_e + 1:]
+            jump = None
+        else:
+            comp = line[index_e + 1:index_j]
+            jump = intern(line[index_j + 1:])
+        return Program.C, None, dest, intern(comp), jump
+
+    def command_type(self):
         """
+        A_COMMAND for @xxx instruction
+        L_COMMAND for (xxx) label
+        C_COMMAND for dest=comp;jump
+        Ignore when the input holds no commands
 
-        c_index = self._line.find('//')
-        a_index = self._line.find('@')
-        l_o_index = self._line.find('(')
-        l_c_index = self._line.find(')')
-        if c_index == -1:
-            c_index = sys.maxint
-        if len(self._line) == 0:
-            # empty line with white spacesk
+        :return:
+        Returns type of current command
+        """
+        if self._current_inst >= len(self.program):
             return Parser.IGNORE
-        # in case of inline comments/no comments in text
-        if a_index != -1 and a_index < c_index:
-            return Parser.A_COMMAND
-        # no comments in text
-        if l_o_index != -1 and l_c_index != -1 and l_o_index < l_c_index and l_o_index < c_index:
-            return Parser.L_COMMAND
-        words = self._line.split()
-        if words[0].find('//') == -1:
-            return Parser.C_COMMAND
-        return Parser.IGNORE
+        return Parser.KINDS[self.program.kinds[self._current_inst]]
 
     def advance(self):
         """
@@ -63,7 +155,6 @@ class Parser:
         Returns pointer to the next command
         """
         self._current_inst += 1
-        self._line = self._lines[self._current_inst].strip()
 
     def has_more_commands(self):
         """
@@ -72,23 +163,16 @@ class Parser:
         :return:
         Returns true if there are more commands, false otherwise
         """
-        return self._current_inst < len(self._lines) - 1
+        return self._current_inst < len(self.program) - 1
 
     def symbol(self):
         """
-        Should only be called when command_type() returns A_COMMAND
+        Should only be called when command_type() returns A_COMMAND or L_COMMAND
 
         :return:
         Returns the symbol of the current command(@xxx/(xxx))
         """
-        if self.command_type() == Parser.A_COMMAND:
-            a_index = self._line.find('@')
-            symbol = self._line[a_index + 1:]
-        else:
-            l_o_index = self._line.find('(')
-            l_c_index = self._line.find(')')
-            symbol = self._line[l_o_index + 1:l_c_index]
-        return symbol
+        return self.program.symbols[self._current_inst]
 
     def dest(self):
         """
@@ -97,13 +181,7 @@ class Parser:
         :return:
         Returns the dest mneumonic in the current C-command(8 possibilities)
         """
-        index = self._line.find("=")
-        if index == -1:
-            return None
-        words = self._line[0: index].split()
-        for w in words:
-            if len(w) != 0:
-                return w
+        return self.program.dests[self._current_inst]
 
     def comp(self):
         """
@@ -112,20 +190,7 @@ class Parser:
         :return:
         Returns the comp mneumonic in the current C-command(28 possibilities)
         """
-        index_e = self._line.find("=")
-        index_j = self._line.find(";")
-        if index_e == -1 and index_j == -1:
-            string = self._line
-        elif index_e == -1:
-            string=  self._line[:index_j]
-        elif index_j == -1:
-            string = self._line[index_e + 1:]
-        else:
-            string = self._line[index_e + 1: index_j]
-        words = string.split()
-        for w in words:
-            if len(w) != 0:
-                return w
+        return self.program.comps[self._current_inst]
 
     def jump(self):
         """
@@ -134,13 +199,7 @@ class Parser:
         :return:
         Returns the jump mneumonic in the current C-command(8 possibilities)
         """
-        index = self._line.find(";")
-        if index == -1:
-            return None
-        words = self._line[index + 1:].split()
-        for w in words:
-            if len(w) != 0:
-                return w
+        return self.program.jumps[self._current_inst]
 
 
 class Code:
@@ -173,7 +232,7 @@ class Code:
         self.comp_dict['D'] = '0001100'
         self.comp_dict['A'] = '0110000'
         self.comp_dict['!D'] = '0001101'
-        self.comp_dict['!A'] = '0110011'
+        self.comp_dict['!A'] = '0110001'
         self.comp_dict['-D'] = '0001111'
         self.comp_dict['-A'] = '0110011'
         self.comp_dict['-A'] = '0110011'
@@ -235,6 +294,64 @@ class Code:
         return self.jump_dict[mneumoic]
 
 
+class Encoder:
+    """
+    Encodes commands into 16 bit integer words.
+    C-instructions are looked up in a table precomputed for every valid dest x comp x jump combination,
+    A-instructions are plain bit arithmetic. Text is only produced when the words are written out
+    """
+    A_MASK = 0x7FFF
+    C_PREFIX = 0xE000
+
+    def __init__(self, code=None):
+        if code is None:
+            code = Code()
+        self.c_table = {}
+        for comp, comp_bits in code.comp_dict.items():
+            comp_word = Encoder.C_PREFIX | int(comp_bits, 2) << 6
+            for dest, dest_bits in code.dest_dict.items():
+                dest_word = comp_word | int(dest_bits, 2) << 3
+                for jump, jump_bits in code.jump_dict.items():
+                    self.c_table[(dest, comp, jump)] = dest_word | int(jump_bits, 2)
+
+    @staticmethod
+    def a_instruction(address):
+        """
+
+        :param address: value(int) loaded into the A register
+        :return:
+        Returns the 16 bit word for the A-instruction, raises if the value does not fit in 15 bits
+        """
+        if address > Encoder.A_MASK:
+            raise Exception("A-instruction value {a} does not fit in 15 bits".format(a=address))
+        return address
+
+    def c_instruction(self, dest, comp, jump):
+        """
+
+        :param dest: dest mneumonic(None if absent)
+        :param comp: comp mneumonic
+        :param jump: jump mneumonic(None if absent)
+        :return:
+        Returns the 16 bit word for the C-instruction, raises if the mnemonics are not valid
+        """
+        try:
+            return self.c_table[(dest, comp, jump)]
+        except KeyError:
+            raise Exception("Invalid C-instruction {d}{c}{j}".format(
+                d=dest + "=" if dest else "", c=comp, j=";" + jump if jump else ""))
+
+    @staticmethod
+    def to_text(words):
+        """
+
+        :param words: iterable of 16 bit words
+        :return:
+        Returns the .hack text with one binary string per line
+        """
+        return ''.join([format(word, '016b') + "\n" for word in words])
+
+
 class SymbolTable:
     """
     Keeps a correspondance between symbolic labels and numeric addresses
@@ -267,6 +384,9 @@ class SymbolTable:
         """
         return symbol in self._symbol_table
 
+    def __len__(self):
+        return len(self._symbol_table)
+
     def get_address(self, symbol):
         """
         :param symbol: symbol from instruction
@@ -287,61 +407,929 @@ class SymbolTable:
         self._symbol_table['KBD'] = 24576
 
 
-class Driver:
+class RomFile:
     """
-    Class to drive program execution
+    Reads and writes assembled ROM images.
+    Text .hack files hold one 16 character binary string per instruction, packed .hackb files hold
+    a small header followed by the instructions as little endian 16 bit words
+    """
+    TEXT_EXTENSION = ".hack"
+    BINARY_EXTENSION = ".hackb"
+    MAGIC = b"HACK"
+    VERSION = 1
+    # magic, version, reserved, instruction count
+    HEADER = struct.Struct("<4sHHI")
+
+    @staticmethod
+    def write_text(file_name, words):
+        """
+        Writes the words as a text .hack file
+
+        :param file_name: output file
+        :param words: iterable of 16 bit words
+        :return:
+        """
+        with open(file_name, "w") as f:
+            f.write(Encoder.to_text(words))
+
+    @staticmethod
+    def write_binary(file_name, words):
+        """
+        Writes the words as a packed .hackb file
+
+        :param file_name: output file
+        :param words: iterable of 16 bit words
+        :return:
+        """
+        words = array('H', words)
+        if sys.byteorder != "little":
+            words.byteswap()
+        with open(file_name, "wb") as f:
+            f.write(RomFile.HEADER.pack(RomFile.MAGIC, RomFile.VERSION, 0, len(words)))
+            words.tofile(f)
+
+    @staticmethod
+    def load_text(file_name):
+        """
+
+        :param file_name: text .hack file
+        :return:
+        Returns the instructions as an array of 16 bit words
+        """
+        with open(file_name, "r") as f:
+            return array('H', [int(line, 2) for line in f if line.strip()])
+
+    @staticmethod
+    def load_binary(file_name):
+        """
+        Memory maps a packed .hackb file. The returned view shares memory with the mapping,
+        no copy is made (except on big endian hosts)
+
+        :param file_name: packed .hackb file
+        :return:
+        Returns the instructions as an indexable sequence of 16 bit words
+        """
+        with open(file_name, "rb") as f:
+            size = RomFile.HEADER.size
+            header = f.read(size)
+            if len(header) != size:
+                raise Exception("Truncated header in {f}".format(f=file_name))
+            magic, version, _, count = RomFile.HEADER.unpack(header)
+            if magic != RomFile.MAGIC or version != RomFile.VERSION:
+                raise Exception("Not a packed hack file: {f}".format(f=file_name))
+            if count == 0:
+                return array('H')
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < size + 2 * count:
+            raise Exception("Truncated instructions in {f}".format(f=file_name))
+        words = memoryview(mapped)[size:size + 2 * count].cast('H')
+        if sys.byteorder != "little":
+            words = array('H', words)
+            words.byteswap()
+        return words
+
+    @staticmethod
+    def load(file_name):
+        """
+        Loads either ROM format, chosen by file extension
+
+        :param file_name: .hack or .hackb file
+        :return:
+        Returns the instructions as an indexable sequence of 16 bit words
+        """
+        if file_name.endswith(RomFile.BINARY_EXTENSION):
+            return RomFile.load_binary(file_name)
+        return RomFile.load_text(file_name)
+
+
+class StreamAssembler:
+    """
+    Single pass assembler reading from any iterable of lines (an open file, sys.stdin, a generator).
+    Instructions are encoded as they are read; uses of symbols that are not known yet are written as
+    placeholders and recorded in a patch list that is fixed up once the input is exhausted.
+    Memory does not grow with the size of the source, but the patch lists hold one entry per use of a
+    forward label or variable, so they grow with the number of such references rather than with the
+    number of distinct symbols. Non seekable outputs (pipes) are spooled to a temporary file that is
+    patched and then copied to the output
+    """
+    # number of words buffered before they are written to a seekable output
+    FLUSH_SIZE = 4096
 
+    def __init__(self, out, binary=False):
+        """
+        :param out: output stream opened in binary mode
+        :param binary: write the packed .hackb format instead of text
+        """
+        self.symbol_table = SymbolTable()
+        self.instruction_count = 0
+        # final destination when out is not seekable, None otherwise
+        self._target = None
+        if not out.seekable():
+            self._target = out
+            out = tempfile.TemporaryFile()
+        self._out = out
+        self._binary = binary
+        self._encoder = Encoder()
+        # symbol -> addresses of the instructions using it, in order of first use
+        self._patches = {}
+        self._buffer = array('H')
+        self._flushed = 0
+        self._base = out.tell()
+        if binary:
+            # instruction count is rewritten once known
+            out.write(RomFile.HEADER.pack(RomFile.MAGIC, RomFile.VERSION, 0, 0))
+            self._base += RomFile.HEADER.size
+
+    def assemble(self, lines):
+        """
+        Assembles every line of the input and finalizes the output
+
+        :param lines: iterable of source lines
+        :return:
+        Returns the number of instructions written
+        """
+        s = self.symbol_table
+        e = self._encoder
+        buffer = self._buffer
+        patches = self._patches
+        lex_line = Parser.lex_line
+        line_number = 0
+        try:
+            for line_number, line in enumerate(lines, 1):
+                record = lex_line(line)
+                if record is None:
+                    continue
+                kind, symbol, dest, comp, jump = record
+                if kind == Program.L:
+                    s.add_entry(symbol, self.instruction_count)
+                    continue
+                if kind == Program.A:
+                    if symbol.isdigit():
+                        word = e.a_instruction(int(symbol))
+                    elif s.contains(symbol):
+                        word = e.a_instruction(s.get_address(symbol))
+                    else:
+                        # forward label or variable, resolved at the end
+                        patches.setdefault(symbol, array('I')).append(self.instruction_count)
+                        word = 0
+                else:
+                    word = e.c_instruction(dest, comp, jump)
+                buffer.append(word)
+                self.instruction_count += 1
+                if len(buffer) >= StreamAssembler.FLUSH_SIZE:
+                    self._flush()
+        except Exception as error:
+            raise Exception("{e} on line {l}".format(e=error, l=line_number))
+        self._finish()
+        return self.instruction_count
+
+    def _flush(self):
+        self._write(self._buffer)
+        self._flushed += len(self._buffer)
+        del self._buffer[:]
+
+    def _write(self, words):
+        if self._binary:
+            words = array('H', words)
+            if sys.byteorder != "little":
+                words.byteswap()
+            self._out.write(words.tobytes())
+        else:
+            self._out.write(Encoder.to_text(words).encode("ascii"))
+
+    def _finish(self):
+        """
+        Allocates variables in order of first use, applies the patch list, writes what is left
+        and copies a spooled output to its destination
+        """
+        s = self.symbol_table
+        ram_address_count = 16  # required for variables
+        width = 2 if self._binary else 17
+        patched = []
+        for symbol, addresses in self._patches.items():
+            if not s.contains(symbol):
+                s.add_entry(symbol, ram_address_count)
+                ram_address_count += 1
+            word = Encoder.a_instruction(s.get_address(symbol))
+            for address in addresses:
+                if address >= self._flushed:
+                    self._buffer[address - self._flushed] = word
+                else:
+                    patched.append((address, word))
+        self._flush()
+        end = self._out.tell()
+        for address, word in sorted(patched):
+            self._out.seek(self._base + address * width)
+            self._write([word])
+        if self._binary:
+            self._out.seek(self._base - RomFile.HEADER.size)
+            self._out.write(RomFile.HEADER.pack(RomFile.MAGIC, RomFile.VERSION, 0, self.instruction_count))
+        self._out.seek(end)
+        if self._target is not None:
+            self._out.seek(0)
+            shutil.copyfileobj(self._out, self._target)
+            self._out.close()
+
+
+class ParallelAssembler:
+    """
+    Assembles large programs by splitting the source into chunks processed in a process pool.
+    Workers first collect chunk local labels, instruction counts and symbol uses; the chunk offsets are
+    merged into one SymbolTable and variables allocated in source order, then the chunks are encoded
+    in parallel. The output is identical to Driver.start
     """
+    # chunks smaller than this are not worth shipping to another process
+    MIN_CHUNK_LINES = 4096
 
     @staticmethod
-    def start(file_name):
+    def assemble(lines, workers=None):
+        """
+
+        :param lines: list of source lines
+        :param workers: number of processes, defaults to the cpu count
+        :return:
+        Returns the instructions as an array of 16 bit words and the filled SymbolTable
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        chunk_lines = max(ParallelAssembler.MIN_CHUNK_LINES, -(-len(lines) // workers))
+        chunks = [lines[i:i + chunk_lines] for i in range(0, len(lines), chunk_lines)]
+        first_lines = range(1, len(lines) + 1, chunk_lines)
+        if len(chunks) <= 1 or workers <= 1:
+            scans = [ParallelAssembler._scan_chunk(chunk) for chunk in chunks]
+            s = ParallelAssembler._merge(scans)
+            encoded = [ParallelAssembler._encode_chunk(chunk, s._symbol_table, first_line)
+                       for chunk, first_line in zip(chunks, first_lines)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                scans = list(pool.map(ParallelAssembler._scan_chunk, chunks))
+                s = ParallelAssembler._merge(scans)
+                encoded = list(pool.map(ParallelAssembler._encode_chunk, chunks, repeat(s._symbol_table),
+                                        first_lines))
+        words = array('H')
+        for chunk_words in encoded:
+            words.frombytes(chunk_words)
+        return words, s
+
+    @staticmethod
+    def _scan_chunk(lines):
+        """
+        First pass over one chunk
+
+        :param lines: source lines of the chunk
+        :return:
+        Returns the instruction count, the (label, chunk local address) pairs and the
+        non numeric A-instruction symbols in order of first use
+        """
+        instruction_count = 0
+        labels = []
+        symbols = {}
+        for line in lines:
+            record = Parser.lex_line(line)
+            if record is None:
+                continue
+            kind, symbol = record[0], record[1]
+            if kind == Program.L:
+                labels.append((symbol, instruction_count))
+                continue
+            if kind == Program.A and not symbol.isdigit():
+                symbols[symbol] = None
+            instruction_count += 1
+        return instruction_count, labels, list(symbols)
+
+    @staticmethod
+    def _merge(scans):
+        """
+        Offsets chunk local labels into a SymbolTable, then allocates variables in source order
+
+        :param scans: results of _scan_chunk in chunk order
+        :return:
+        Returns the SymbolTable
+        """
         s = SymbolTable()
-        p = Parser(file_name)
-        c = Code()
+        offset = 0
+        for instruction_count, labels, _ in scans:
+            for symbol, address in labels:
+                s.add_entry(symbol, offset + address)
+            offset += instruction_count
+        ram_address_count = 16  # required for variables
+        for _, _, symbols in scans:
+            for symbol in symbols:
+                if not s.contains(symbol):
+                    s.add_entry(symbol, ram_address_count)
+                    ram_address_count += 1
+        return s
+
+    @staticmethod
+    def _encode_chunk(lines, symbol_table, first_line=1):
+        """
+        Second pass over one chunk, every symbol is already resolved
+
+        :param lines: source lines of the chunk
+        :param symbol_table: symbol -> address dict
+        :param first_line: 1-based source line number of the first line of the chunk
+        :return:
+        Returns the encoded words as bytes
+        """
+        e = Encoder()
+        words = array('H')
+        line_number = first_line
+        try:
+            for line_number, line in enumerate(lines, first_line):
+                record = Parser.lex_line(line)
+                if record is None:
+                    continue
+                kind, symbol, dest, comp, jump = record
+                if kind == Program.A:
+                    address = int(symbol) if symbol.isdigit() else symbol_table[symbol]
+                    words.append(e.a_instruction(address))
+                elif kind == Program.C:
+                    words.append(e.c_instruction(dest, comp, jump))
+        except Exception as error:
+            raise Exception("{e} on line {l}".format(e=error, l=line_number))
+        return words.tobytes()
+
+
+class DebugSymbols:
+    """
+    Debug sidecar of an assembled program: the ROM address of every label, the RAM address of every
+    variable and the source line of every ROM address, stored as a compact JSON index so profilers and
+    emulators can map addresses back to the .asm source without parsing it
+    """
+    EXTENSION = ".dbg.json"
+    VERSION = 1
+
+    def __init__(self, source, labels, variables, lines):
+        """
+        :param source: name of the .asm file
+        :param labels: label -> ROM address
+        :param variables: variable -> RAM address
+        :param lines: 1-based source line for each ROM address
+        """
+        self.source = source
+        self.labels = labels
+        self.variables = variables
+        self.lines = lines
+        self._sorted_labels = None
+
+    def write(self, file_name):
+        """
+        :param file_name: output sidecar file
+        :return:
+        """
+        index = {"version": DebugSymbols.VERSION, "source": self.source, "labels": self.labels,
+                 "variables": self.variables, "lines": list(self.lines)}
+        with open(file_name, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+
+    @staticmethod
+    def load(file_name):
+        """
+        :param file_name: sidecar file written by write
+        :return:
+        Returns the DebugSymbols stored in the file
+        """
+        with open(file_name, "r") as f:
+            index = json.load(f)
+        if index.get("version") != DebugSymbols.VERSION:
+            raise Exception("Unsupported debug symbols version in {f}".format(f=file_name))
+        return DebugSymbols(index["source"], index["labels"], index["variables"], array('I', index["lines"]))
+
+    def source_line(self, address):
+        """
+        :param address: ROM address
+        :return:
+        Returns the source line the instruction at address was assembled from
+        """
+        return self.lines[address]
+
+    def nearest_label(self, address):
+        """
+        :param address: ROM address
+        :return:
+        Returns the closest label at or before address, None if there is none
+        """
+        if self._sorted_labels is None:
+            ordered = sorted(self.labels.items(), key=lambda item: item[1])
+            self._sorted_labels = ([a for _, a in ordered], [l for l, _ in ordered])
+        addresses, names = self._sorted_labels
+        i = bisect_right(addresses, address)
+        return names[i - 1] if i else None
+
+
+class Optimizer:
+    """
+    ROM size optimizing pass over a lexed Program, run before the assembler computes label addresses.
+    Threads jumps whose target is another unconditional jump, drops unreachable code after
+    unconditional jumps up to the next label and removes @X loads when A provably holds X already.
+    Code addresses must be symbolic: programs using numeric jump targets cannot be relocated
+    """
+
+    def __init__(self):
+        self.stats = {"threaded_jumps": 0, "unreachable": 0, "redundant_loads": 0}
+        self._predefined = SymbolTable()
+
+    def optimize(self, program):
+        """
+
+        :param program: Program lexed by the Parser
+        :return:
+        Returns a new, smaller Program
+        """
+        records = list(zip(program.kinds, program.symbols, program.dests, program.comps, program.jumps,
+                           program.lines))
+        self._check_relocatable(records)
+        records = self._thread_jumps(records)
+        records = self._remove_unreachable(records)
+        records = self._remove_redundant_loads(records)
+        optimized = Program()
+        for record in records:
+            optimized.append(record[:5], record[5])
+        return optimized
+
+    @staticmethod
+    def _feeds_jump(records, i):
+        """
+        Is record i an A-instruction whose value is used as a jump target by the next instruction
+        """
+        return (records[i][0] == Program.A and i + 1 < len(records) and records[i + 1][0] == Program.C
+                and records[i + 1][4] is not None)
+
+    def _check_relocatable(self, records):
+        for i, record in enumerate(records):
+            if self._feeds_jump(records, i) and record[1].isdigit():
+                raise Exception("Numeric jump target @{s} on line {l}, the program cannot be optimized".format(
+                    s=record[1], l=record[5]))
+
+    def _thread_jumps(self, records):
+        # index of the first instruction following each label
+        label_at = {}
+        pending = []
+        for i, record in enumerate(records):
+            if record[0] == Program.L:
+                pending.append(record[1])
+                continue
+            for label in pending:
+                label_at[label] = i
+            pending = []
+        # labels whose first instruction is an unconditional jump to another label
+        forward = {}
+        for label, i in label_at.items():
+            target = records[i][1]
+            if (self._feeds_jump(records, i) and target in label_at and records[i + 1][4] == "JMP"
+                    and records[i + 1][2] is None):
+                forward[label] = target
+        threaded = []
+        for i, record in enumerate(records):
+            if self._feeds_jump(records, i) and record[1] in forward:
+                target = record[1]
+                seen = {target}
+                while target in forward and forward[target] not in seen:
+                    target = forward[target]
+                    seen.add(target)
+                if target != record[1]:
+                    record = (record[0], target) + record[2:]
+                    self.stats["threaded_jumps"] += 1
+            threaded.append(record)
+        return threaded
+
+    def _remove_unreachable(self, records):
+        reachable = []
+        dead = False
+        for record in records:
+            if record[0] == Program.L:
+                dead = False
+            elif dead:
+                self.stats["unreachable"] += 1
+                continue
+            elif record[0] == Program.C and record[4] == "JMP":
+                dead = True
+            reachable.append(record)
+        return reachable
+
+    def _address_key(self, symbol):
+        """
+        Numeric constants and predefined symbols compare by value, other symbols by name
+        """
+        if symbol.isdigit():
+            return int(symbol)
+        if self._predefined.contains(symbol):
+            return self._predefined.get_address(symbol)
+        return symbol
+
+    def _remove_redundant_loads(self, records):
+        kept = []
+        # value held by A, None when unknown
+        a = None
+        for record in records:
+            kind = record[0]
+            if kind == Program.L:
+                a = None
+            elif kind == Program.A:
+                key = self._address_key(record[1])
+                if key == a:
+                    self.stats["redundant_loads"] += 1
+                    continue
+                a = key
+            elif record[2] is not None and "A" in record[2]:
+                a = None
+            kept.append(record)
+        return kept
+
+
+class Profile:
+    """
+    Wall time spent in each assembly phase and instruction/symbol counters of one assembly run
+    """
+
+    def __init__(self):
+        # phase -> seconds, in the order the phases ran
+        self.times = {}
+        self.counters = {"a_instructions": 0, "c_instructions": 0, "l_instructions": 0, "variables": 0,
+                         "symbol_lookups": 0}
+        self._phase = None
+        self._start = 0.0
+
+    def start(self, phase):
+        """
+        Starts timing the given phase
+        :param phase: name of the phase
+        :return:
+        """
+        self._phase = phase
+        self._start = time.perf_counter()
+
+    def stop(self):
+        """
+        Stops timing the current phase
+        :return:
+        """
+        elapsed = time.perf_counter() - self._start
+        self.times[self._phase] = self.times.get(self._phase, 0.0) + elapsed
+        self._phase = None
+
+    def to_dict(self):
+        return {"times": dict(self.times), "counters": dict(self.counters)}
+
+
+class CountingSymbolTable(SymbolTable):
+    """
+    SymbolTable counting its lookups into a Profile
+    """
+
+    def __init__(self, profile):
+        SymbolTable.__init__(self)
+        self._counters = profile.counters
+
+    def contains(self, symbol):
+        self._counters["symbol_lookups"] += 1
+        return SymbolTable.contains(self, symbol)
+
+    def get_address(self, symbol):
+        self._counters["symbol_lookups"] += 1
+        return SymbolTable.get_address(self, symbol)
+
+
+class Assembler:
+    """
+    Two pass assembler over a lexed Program, does no file I/O.
+    Keeps the symbol table, the labels and variables it defined and the encoded words
+    """
+    _encoder = None
+
+    def __init__(self, optimize=False, profile=False):
+        """
+        :param optimize: run the Optimizer over the program before assembling it
+        :param profile: count symbol table lookups in the Profile, phases are always timed
+        """
+        if Assembler._encoder is None:
+            Assembler._encoder = Encoder()
+        self.optimizer = Optimizer() if optimize else None
+        self.profile = Profile()
+        self.symbol_table = CountingSymbolTable(self.profile) if profile else SymbolTable()
+        self.labels = {}
+        self.variables = {}
+        # resolved value of every A-instruction
+        self.addresses = array('l')
+        self.words = array('H')
+        self.program = None
+
+    def assemble(self, program):
+        """
+
+        :param program: Program lexed by the Parser
+        :return:
+        Returns the instructions as an array of 16 bit words
+        """
+        profile = self.profile
+        if self.optimizer is not None:
+            profile.start("optimizing")
+            program = self.optimizer.optimize(program)
+            profile.stop()
+        self.program = program
+        profile.start("pass_one")
+        self.first_pass()
+        profile.stop()
+        profile.start("pass_two")
+        self.second_pass()
+        profile.stop()
+        profile.start("encoding")
+        self.encode()
+        profile.stop()
+        counters = profile.counters
+        counters["a_instructions"] = program.kinds.count(Program.A)
+        counters["c_instructions"] = program.kinds.count(Program.C)
+        counters["l_instructions"] = program.kinds.count(Program.L)
+        counters["variables"] = len(self.variables)
+        return self.words
+
+    def first_pass(self):
+        """
+        Adds program labels to the symbol table
+        :return:
+        """
+        s = self.symbol_table
         instruction_count = 0
-        # first pass - adding program labels to the symbol table
-        while True:
-            if p.command_type() == Parser.A_COMMAND or p.command_type() == Parser.C_COMMAND:
-                instruction_count += 1
-            if p.command_type() == Parser.L_COMMAND:
-                symbol = p.symbol()
+        for kind, symbol in zip(self.program.kinds, self.program.symbols):
+            if kind == Program.L:
                 s.add_entry(symbol, instruction_count)
-            if p.has_more_commands():
-                p.advance()
+                self.labels[symbol] = instruction_count
             else:
-                break
+                instruction_count += 1
 
+    def second_pass(self):
+        """
+        Allocates variables and resolves the value of every A-instruction
+        :return:
+        """
+        s = self.symbol_table
+        addresses = self.addresses
         ram_address_count = 16  # required for variables
-        index = file_name.find(".")
-        new_file = file_name[0:index] + ".hack"
-        file = open(new_file, "w")
-        # second pass
-        p = Parser(file_name)
-        while True:
-            if p.command_type() == Parser.A_COMMAND:
-                symbol = p.symbol()
-                if not symbol.isdigit() and not s.contains(symbol):
+        for kind, symbol in zip(self.program.kinds, self.program.symbols):
+            if kind == Program.A:
+                if symbol.isdigit():
+                    address = int(symbol)
+                elif s.contains(symbol):
+                    address = s.get_address(symbol)
+                else:
                     address = ram_address_count
                     s.add_entry(symbol, address)
+                    self.variables[symbol] = address
                     ram_address_count += 1
-                elif s.contains(symbol):
-                    address = s.get_address(symbol)
+                addresses.append(address)
+
+    def encode(self):
+        """
+        Encodes every instruction into a 16 bit word
+        :return:
+        """
+        e = Assembler._encoder
+        program = self.program
+        words = self.words
+        addresses = iter(self.addresses)
+        line = 0
+        try:
+            for kind, dest, comp, jump, line in zip(program.kinds, program.dests, program.comps, program.jumps,
+                                                    program.lines):
+                if kind == Program.A:
+                    words.append(e.a_instruction(next(addresses)))
+                elif kind == Program.C:
+                    words.append(e.c_instruction(dest, comp, jump))
+        except Exception as error:
+            raise Exception("{e} on line {l}".format(e=error, l=line))
+
+    def debug_symbols(self, source):
+        """
+        :param source: name of the assembled source
+        :return:
+        Returns the DebugSymbols of the last assembled program
+        """
+        program = self.program
+        lines = array('I', [line for kind, line in zip(program.kinds, program.lines) if kind != Program.L])
+        return DebugSymbols(source, self.labels, self.variables, lines)
+
+
+def assemble_lines(lines, optimize=False):
+    """
+    Assembles an iterable of source lines without any file I/O
+
+    :param lines: iterable of assembly source lines
+    :param optimize: run the ROM size Optimizer first
+    :return:
+    Returns the instructions as an array of 16 bit words
+    """
+    return Assembler(optimize).assemble(Parser.lex(lines))
+
+
+def assemble(source, optimize=False):
+    """
+    Assembles source text without any file I/O
+
+    :param source: assembly source as a string
+    :param optimize: run the ROM size Optimizer first
+    :return:
+    Returns the instructions as an array of 16 bit words
+    """
+    return assemble_lines(source.splitlines(), optimize)
+
+
+class Driver:
+    """
+    Class to drive program execution
+
+    """
+
+    @staticmethod
+    def output_name(file_name, extension):
+        """
+        :param file_name: .asm file
+        :param extension: extension of the output
+        :return:
+        Returns the output file next to file_name
+        """
+        return os.path.splitext(file_name)[0] + extension
+
+    @staticmethod
+    def write(file_name, words, binary=False, output=None):
+        """
+        Writes the words in the requested format to output, or next to file_name
+
+        :param file_name: .asm file
+        :param words: 16 bit instruction words
+        :param binary: write a packed .hackb file instead of text
+        :param output: output file
+        :return:
+        """
+        if binary:
+            RomFile.write_binary(output or Driver.output_name(file_name, RomFile.BINARY_EXTENSION), words)
+        else:
+            RomFile.write_text(output or Driver.output_name(file_name, RomFile.TEXT_EXTENSION), words)
+
+    @staticmethod
+    def start(file_name, binary=False, debug=False, output=None, optimize=False, profile=False):
+        """
+        Assembles file_name into a .hack file next to it
+
+        :param file_name: .asm file
+        :param binary: write a packed .hackb file instead of text
+        :param debug: also write a DebugSymbols sidecar
+        :param output: output file, derived from file_name by default
+        :param optimize: run the ROM size Optimizer first
+        :param profile: also count symbol table lookups in the assembler's Profile
+        :return:
+        Returns the Assembler holding the words, symbols and Profile
+        """
+        assembler = Assembler(optimize, profile)
+        assembler.profile.start("reading")
+        p = Parser(file_name)
+        assembler.profile.stop()
+        words = assembler.assemble(p.program)
+        assembler.profile.start("writing")
+        Driver.write(file_name, words, binary, output)
+        if debug:
+            sidecar = Driver.output_name(output or file_name, DebugSymbols.EXTENSION)
+            assembler.debug_symbols(file_name).write(sidecar)
+        assembler.profile.stop()
+        return assembler
+
+    @staticmethod
+    def start_parallel(file_name, binary=False, workers=None, output=None):
+        """
+        Assembles file_name like start, using a ParallelAssembler process pool
+
+        :param file_name: .asm file
+        :param binary: write a packed .hackb file instead of text
+        :param workers: number of processes, defaults to the cpu count
+        :param output: output file, derived from file_name by default
+        :return:
+        Returns the instructions as an array of 16 bit words and the filled SymbolTable
+        """
+        with open(file_name, 'r') as f:
+            lines = f.readlines()
+        words, s = ParallelAssembler.assemble(lines, workers)
+        Driver.write(file_name, words, binary, output)
+        return words, s
+
+    @staticmethod
+    def sources(paths):
+        """
+        :param paths: .asm files and directories
+        :return:
+        Returns the .asm files, directories are expanded to the .asm files they contain
+        """
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".asm"))
+            else:
+                files.append(path)
+        return files
+
+    @staticmethod
+    def assemble_file(file_name, args):
+        """
+        Assembles one file as requested on the command line, errors are reported, not raised
+
+        :param file_name: .asm file
+        :param args: parsed command line options
+        :return:
+        Returns a summary dict: file, instructions, symbols, elapsed seconds, optimizer stats,
+        profile and error, the last three None when not applicable
+        """
+        result = {"file": file_name, "instructions": 0, "symbols": 0, "elapsed": 0.0, "optimizer": None,
+                  "profile": None, "error": None}
+        start = time.perf_counter()
+        try:
+            if args.stream:
+                output = args.output or Driver.output_name(
+                    file_name, RomFile.BINARY_EXTENSION if args.binary else RomFile.TEXT_EXTENSION)
+                with open(file_name, "r") as f, open(output, "wb") as out:
+                    assembler = StreamAssembler(out, args.binary)
+                    result["instructions"] = assembler.assemble(f)
+                s = assembler.symbol_table
+            elif args.parallel:
+                words, s = Driver.start_parallel(file_name, args.binary, args.parallel, args.output)
+                result["instructions"] = len(words)
+            else:
+                assembler = Driver.start(file_name, args.binary, args.debug, args.output, args.optimize,
+                                         args.profile)
+                result["instructions"] = len(assembler.words)
+                s = assembler.symbol_table
+                if assembler.optimizer is not None:
+                    result["optimizer"] = assembler.optimizer.stats
+                if args.profile:
+                    result["profile"] = assembler.profile.to_dict()
+            result["symbols"] = len(s) - len(SymbolTable())
+        except Exception as e:
+            result["error"] = "{t}: {e}".format(t=type(e).__name__, e=e)
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    @staticmethod
+    def main(argv=None):
+        """
+        Command line interface. Several files or directories are assembled concurrently in a process pool,
+        '-' as input streams stdin to stdout
+        :return:
+        Returns the exit status, 1 if any file failed
+        """
+        parser = argparse.ArgumentParser(description="Assembles Hack assembly into machine code")
+        parser.add_argument("sources", nargs="+", metavar="source",
+                            help=".asm file or directory of .asm files, - reads stdin and writes stdout")
+        parser.add_argument("-o", "--output", help="output file, defaults to the source name with .hack/.hackb")
+        parser.add_argument("-b", "--binary", action="store_true", help="write the packed .hackb format")
+        parser.add_argument("-g", "--debug", action="store_true", help="write a .dbg.json debug symbols sidecar")
+        parser.add_argument("-p", "--parallel", type=int, metavar="WORKERS",
+                            help="assemble each file in chunks over a pool of WORKERS processes")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                            help="number of files assembled concurrently")
+        parser.add_argument("--stream", action="store_true", help="single pass streaming assembly")
+        parser.add_argument("-O", "--optimize", action="store_true", help="optimize the program for ROM size")
+        parser.add_argument("--profile", action="store_true",
+                            help="report per phase times and counters as one JSON object per file")
+        args = parser.parse_args(argv)
+        stdin = args.sources == ["-"]
+        for option in ("debug", "optimize", "profile"):
+            if getattr(args, option) and (stdin or args.stream or args.parallel):
+                parser.error("--{o} is only supported by the two pass assembler".format(o=option))
+        if stdin:
+            try:
+                if args.output:
+                    with open(args.output, "wb") as out:
+                        StreamAssembler(out, args.binary).assemble(sys.stdin)
                 else:
-                    address = symbol
-                # now do translation
-                out = numpy.binary_repr(int(address), 15)
-                file.write("0" + out + "\n")
-            if p.command_type() == Parser.C_COMMAND:
-                out = c.comp(p.comp()) + c.dest(p.dest()) + c.jump(p.jump())
-                file.write("111" + out + "\n")
-            if p.has_more_commands():
-                p.advance()
+                    StreamAssembler(sys.stdout.buffer, args.binary).assemble(sys.stdin)
+            except Exception as e:
+                sys.stderr.write("-: FAILED {t}: {e}\n".format(t=type(e).__name__, e=e))
+                return 1
+            sys.stdout.flush()
+            return 0
+        files = Driver.sources(args.sources)
+        if "-" in files:
+            parser.error("- can not be combined with other sources")
+        if args.output and len(files) != 1:
+            parser.error("--output requires exactly one source file")
+        if len(files) > 1 and args.jobs > 1 and not args.parallel:
+            with ProcessPoolExecutor(max_workers=min(args.jobs, len(files))) as pool:
+                results = list(pool.map(Driver.assemble_file, files, repeat(args)))
+        else:
+            results = [Driver.assemble_file(file_name, args) for file_name in files]
+        failed = 0
+        for result in results:
+            if result["error"] is not None:
+                failed += 1
+                sys.stderr.write("{f}: FAILED {e}\n".format(f=result["file"], e=result["error"]))
+            elif args.profile:
+                print(json.dumps(result))
             else:
-                break
+                print("{f}: {i} instructions, {s} symbols, {t:.3f}s{o}".format(
+                    f=result["file"], i=result["instructions"], s=result["symbols"], t=result["elapsed"],
+                    o=" " + json.dumps(result["optimizer"]) if result["optimizer"] is not None else ""))
+        return 1 if failed else 0
 
 
 if __name__ == '__main__':
     """
     Entry point of program for execution
     """
-    Driver.start("Max.asm")
+    sys.exit(Driver.main())
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import numpy
+from hack_assembly import assemble, RomFile
+from hack_emulator import Emulator
+
+
+class Benchmark:
+    """
+    Cycle count benchmarks of the Hack assembly programs.
+    Each scenario assembles its program, runs it on the Emulator with scripted RAM and keyboard input
+    and records the instructions executed to completion (or to a steady screen), the observable result
+    and the wall time. Results and instruction counts are compared against stored baselines, wall times
+    depend on the machine and are only reported
+    """
+    ROOT = os.path.dirname(os.path.abspath(__file__))
+    MULT = os.path.join(ROOT, "..", "project4", "mult", "Mult.asm")
+    FILL = os.path.join(ROOT, "..", "project4", "fill", "Fill.asm")
+    MAX = os.path.join(ROOT, "Max.asm")
+    PONG = os.path.join(ROOT, "PongL.asm")
+    PONG_ROM = os.path.join(ROOT, "Pong.hack")
+    BASELINE = os.path.join(ROOT, "benchmarks.json")
+    # instructions between two checks of a steady state condition, the exact cycle is then found by
+    # replaying the last interval one instruction at a time
+    CHECK_INTERVAL = 1000
+    # safety net for programs that never reach their end state
+    MAX_CYCLES = 50000000
+    # runs faster than this are too noisy to report wall time changes
+    MIN_TIMED_SECONDS = 0.1
+    # Hack character codes of the arrow keys
+    LEFT_ARROW = 130
+    RIGHT_ARROW = 132
+    # screen row crossing the Pong paddle
+    PADDLE_ROW = 232
+
+    def __init__(self, compiled=False):
+        """
+        :param compiled: run the emulator in basic block compilation mode
+        """
+        self.compiled = compiled
+        self.scenarios = [("mult", self.mult), ("max", self.max), ("fill", self.fill), ("pong", self.pong)]
+
+    def run_all(self):
+        """
+        :return:
+        Returns scenario name -> {"cycles", "result", "assemble_seconds", "run_seconds"}
+        """
+        return dict((name, scenario()) for name, scenario in self.scenarios)
+
+    @staticmethod
+    def _assemble(file_name):
+        start = time.perf_counter()
+        with open(file_name, "r") as f:
+            words = assemble(f.read())
+        return words, time.perf_counter() - start
+
+    def _run_to_halt(self, emulator):
+        emulator.run(Benchmark.MAX_CYCLES)
+        if not emulator.halted:
+            raise Exception("Program did not halt within {c} instructions".format(c=Benchmark.MAX_CYCLES))
+
+    def _run_until(self, emulator, condition):
+        """
+        Runs until condition(emulator) first holds, exactly at that instruction. The condition is checked
+        every CHECK_INTERVAL instructions; once it holds the emulator is rewound to the start of the
+        interval and the interval is replayed one instruction at a time
+        """
+        if condition(emulator):
+            return
+        while True:
+            if emulator.cycles >= Benchmark.MAX_CYCLES or emulator.halted:
+                raise Exception("Steady state not reached within {c} instructions".format(c=emulator.cycles))
+            state = Benchmark._save(emulator)
+            emulator.run(Benchmark.CHECK_INTERVAL)
+            if condition(emulator):
+                break
+        Benchmark._restore(emulator, state)
+        while not condition(emulator):
+            emulator.run(1)
+
+    @staticmethod
+    def _save(emulator):
+        return list(emulator.ram), emulator.pc, emulator.a, emulator.d, emulator.cycles, emulator.elapsed
+
+    @staticmethod
+    def _restore(emulator, state):
+        ram, emulator.pc, emulator.a, emulator.d, emulator.cycles, emulator.elapsed = state
+        emulator.ram[:] = ram
+        emulator.halted = False
+
+    def _programs(self, file_name, inputs, outputs):
+        """
+        Runs one program to halt for every set of RAM inputs
+
+        :param file_name: .asm file
+        :param inputs: list of {address: value} RAM contents
+        :param outputs: RAM addresses whose final values make up the result
+        :return:
+        Returns the benchmark record summed over every input
+        """
+        words, assemble_seconds = Benchmark._assemble(file_name)
+        cycles = 0
+        run_seconds = 0.0
+        result = []
+        for ram in inputs:
+            emulator = Emulator(words, self.compiled)
+            for address, value in ram.items():
+                emulator.ram[address] = value
+            self._run_to_halt(emulator)
+            cycles += emulator.cycles
+            run_seconds += emulator.elapsed
+            result.append([emulator.ram[address] for address in outputs])
+        return {"cycles": cycles, "result": result, "assemble_seconds": assemble_seconds,
+                "run_seconds": run_seconds}
+
+    def mult(self):
+        inputs = [{0: 0, 1: 7}, {0: 6, 1: 7}, {0: 123, 1: 45}, {0: 2, 1: 999}]
+        return self._programs(Benchmark.MULT, inputs, [2])
+
+    def max(self):
+        inputs = [{0: 3, 1: 9}, {0: 9, 1: 3}, {0: 5, 1: 5}]
+        return self._programs(Benchmark.MAX, inputs, [2])
+
+    def fill(self):
+        """
+        Holds a key until the screen is black, then releases it until the screen is clear
+        """
+        words, assemble_seconds = Benchmark._assemble(Benchmark.FILL)
+        emulator = Emulator(words, self.compiled)
+        emulator.set_key(ord("A"))
+        self._run_until(emulator, lambda e: (e.screen_words() == 0xFFFF).all())
+        black = emulator.cycles
+        emulator.set_key(0)
+        self._run_until(emulator, lambda e: not e.screen_words().any())
+        return {"cycles": emulator.cycles, "result": [black], "assemble_seconds": assemble_seconds,
+                "run_seconds": emulator.elapsed}
+
+    def pong(self):
+        """
+        Runs until the first frame is drawn, then plays a fixed script of paddle moves.
+        The result is the startup instruction count, then the paddle column and a hash of the screen
+        after every move
+        """
+        words, assemble_seconds = Benchmark._assemble(Benchmark.PONG)
+        if list(words) != list(RomFile.load(Benchmark.PONG_ROM)):
+            raise Exception("PongL.asm does not assemble to Pong.hack")
+        emulator = Emulator(words, self.compiled)
+        self._run_until(emulator, lambda e: e.screen_words().any())
+        script = [(Benchmark.LEFT_ARROW, 1000000), (0, 500000), (Benchmark.RIGHT_ARROW, 1000000)]
+        result = [emulator.cycles]
+        for key, cycles in script:
+            emulator.set_key(key)
+            emulator.run(cycles)
+            words = emulator.screen_words()
+            result.append([Benchmark._paddle(Emulator.unpack_screen(words)), zlib.crc32(words.tobytes())])
+        return {"cycles": emulator.cycles, "result": result, "assemble_seconds": assemble_seconds,
+                "run_seconds": emulator.elapsed}
+
+    @staticmethod
+    def _paddle(pixels):
+        """
+        :param pixels: 256x512 screen pixels
+        :return:
+        Returns the first column of the widest lit run on the paddle row, -1 if the row is dark
+        """
+        row = numpy.concatenate(([0], pixels[Benchmark.PADDLE_ROW].astype(numpy.int8), [0]))
+        edges = numpy.flatnonzero(numpy.diff(row))
+        if len(edges) == 0:
+            return -1
+        starts, ends = edges[0::2], edges[1::2]
+        return int(starts[numpy.argmax(ends - starts)])
+
+    @staticmethod
+    def compare(results, baselines):
+        """
+        :param results: output of run_all
+        :param baselines: stored output of an earlier run_all
+        :return:
+        Returns a list of regression messages, empty if nothing regressed. Wall times are not compared,
+        they vary too much between runs and machines, see timings
+        """
+        regressions = []
+        for name, result in results.items():
+            baseline = baselines.get(name)
+            if baseline is None:
+                continue
+            if result["result"] != baseline["result"]:
+                regressions.append("{n}: result {r} differs from baseline {b}".format(
+                    n=name, r=result["result"], b=baseline["result"]))
+            if result["cycles"] > baseline["cycles"]:
+                regressions.append("{n}: {c} instructions, baseline {b}".format(
+                    n=name, c=result["cycles"], b=baseline["cycles"]))
+        return regressions
+
+    @staticmethod
+    def timings(results, baselines):
+        """
+        :param results: output of run_all
+        :param baselines: stored output of an earlier run_all
+        :return:
+        Returns report lines of the wall times against the baseline, for information only
+        """
+        lines = []
+        for name, result in results.items():
+            baseline = baselines.get(name)
+            if baseline is None:
+                continue
+            for timing in ("assemble_seconds", "run_seconds"):
+                if baseline[timing] >= Benchmark.MIN_TIMED_SECONDS:
+                    lines.append("{n}: {t} {s:.3f}, baseline {b:.3f} ({r:+.0%})".format(
+                        n=name, t=timing, s=result[timing], b=baseline[timing],
+                        r=result[timing] / baseline[timing] - 1))
+        return lines
+
+    @staticmethod
+    def main(argv=None):
+        """
+        Command line interface
+        :return:
+        Returns the exit status, 1 on any result or instruction count regression
+        """
+        parser = argparse.ArgumentParser(description="Runs the Hack program benchmarks")
+        parser.add_argument("--baseline", default=Benchmark.BASELINE, help="baseline JSON file")
+        parser.add_argument("--update", action="store_true", help="store the results as the new baseline")
+        parser.add_argument("--jit", action="store_true", help="run the emulator in compiled mode")
+        args = parser.parse_args(argv)
+        results = Benchmark(args.jit).run_all()
+        for name, result in results.items():
+            print("{n}: {c} instructions, assemble {a:.3f}s, run {r:.3f}s".format(
+                n=name, c=result["cycles"], a=result["assemble_seconds"], r=result["run_seconds"]))
+        if args.update:
+            with open(args.baseline, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            return 0
+        if not os.path.exists(args.baseline):
+            sys.stderr.write("No baseline at {b}, run with --update\n".format(b=args.baseline))
+            return 1
+        with open(args.baseline, "r") as f:
+            baselines = json.load(f)
+        for line in Benchmark.timings(results, baselines):
+            print("timing " + line)
+        regressions = Benchmark.compare(results, baselines)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION " + regression + "\n")
+        return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    """
+    Entry point of program for execution
+    """
+    sys.exit(Benchmark.main())
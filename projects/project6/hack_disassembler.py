@@ -0,0 +1,94 @@
+import sys
+import argparse
+import numpy
+from hack_assembly import Code, RomFile
+
+
+class Disassembler:
+    """
+    Translates Hack machine code back to assembly language.
+    The whole ROM is decoded at once with NumPy bit masks against inverse tables of the Code mneumonics;
+    every address loaded by an @N immediately before a jump gets a recovered label
+    """
+    LABEL = "L{a}"
+
+    def __init__(self):
+        code = Code()
+        # inverse tables indexed by the dest/jump bits and by the a-bit + c-bits of the comp field
+        self.dest_names = numpy.full(8, "", dtype=object)
+        for mneumonic, bits in code.dest_dict.items():
+            if mneumonic is not None:
+                self.dest_names[int(bits, 2)] = mneumonic + "="
+        self.jump_names = numpy.full(8, "", dtype=object)
+        for mneumonic, bits in code.jump_dict.items():
+            if mneumonic is not None:
+                self.jump_names[int(bits, 2)] = ";" + mneumonic
+        self.comp_names = numpy.full(128, None, dtype=object)
+        for mneumonic, bits in code.comp_dict.items():
+            self.comp_names[int(bits, 2)] = mneumonic
+
+    def disassemble(self, words):
+        """
+
+        :param words: sequence of 16 bit instruction words
+        :return:
+        Returns the assembly source as a list of lines
+        """
+        words = numpy.asarray(words, dtype=numpy.uint16)
+        size = len(words)
+        if size == 0:
+            return []
+        is_c = (words & 0x8000) != 0
+        values = (words & 0x7FFF).astype(numpy.int64)
+        comp = (words >> 6) & 0x7F
+        jump = words & 0x7
+        comps = self.comp_names[comp]
+        invalid = numpy.flatnonzero(is_c & numpy.equal(comps, None))
+        if len(invalid):
+            address = int(invalid[0])
+            raise Exception("Invalid instruction {w:016b} at address {a}".format(w=int(words[address]), a=address))
+        c_text = self.dest_names[(words >> 3) & 0x7] + numpy.where(is_c, comps, "") + self.jump_names[jump]
+        a_text = numpy.char.add("@", values.astype(str)).astype(object)
+        # label recovery, @N right before a jump instruction loads a jump target
+        feeds_jump = numpy.zeros(size, dtype=bool)
+        feeds_jump[:-1] = ~is_c[:-1] & is_c[1:] & (jump[1:] != 0) & (values[:-1] < size)
+        targets = numpy.unique(values[feeds_jump])
+        label_names = numpy.full(size, None, dtype=object)
+        label_names[targets] = [Disassembler.LABEL.format(a=t) for t in targets.tolist()]
+        a_text[feeds_jump] = "@" + label_names[values[feeds_jump]]
+        text = numpy.where(is_c, c_text, a_text).tolist()
+        lines = []
+        start = 0
+        for target in targets.tolist():
+            lines.extend(text[start:target])
+            lines.append("(" + label_names[target] + ")")
+            start = target
+        lines.extend(text[start:])
+        return lines
+
+    @staticmethod
+    def start(file_name, out):
+        """
+        Disassembles a .hack or .hackb file
+
+        :param file_name: ROM image
+        :param out: text stream the assembly is written to
+        :return:
+        """
+        lines = Disassembler().disassemble(RomFile.load(file_name))
+        out.write("".join(line + "\n" for line in lines))
+
+
+if __name__ == '__main__':
+    """
+    Entry point of program for execution
+    """
+    parser = argparse.ArgumentParser(description="Disassembles a Hack ROM image")
+    parser.add_argument("rom", help=".hack or .hackb file")
+    parser.add_argument("-o", "--output", help="output .asm file, defaults to stdout")
+    args = parser.parse_args()
+    if args.output:
+        with open(args.output, "w") as f:
+            Disassembler.start(args.rom, f)
+    else:
+        Disassembler.start(args.rom, sys.stdout)
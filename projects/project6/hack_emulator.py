@@ -0,0 +1,606 @@
+import sys
+import time
+import re
+import argparse
+from array import array
+import numpy
+from hack_assembly import SymbolTable, RomFile, DebugSymbols
+
+
+class Emulator:
+    """
+    Executes assembled Hack ROM images.
+    Every ROM word is decoded once into an opcode tuple, execution is a tight dispatch loop over a flat
+    integer RAM with the screen and keyboard memory mapped where the assembler's SymbolTable puts them.
+    The RAM is a list, the fastest container for the scalar accesses of the execution loops. With
+    numpy_ram it is an array('H') exposed without copying as the NumPy uint16 array memory, so the
+    screen can be read as a live view; this costs about 10% in the interpreter and 30% in compiled mode
+    """
+    # opcodes of decoded instructions
+    OP_A = 0
+    OP_C = 1
+    # unconditional jump back onto its own @label (the (END) @END 0;JMP idiom) or running off the ROM
+    OP_HALT = 2
+
+    RAM_SIZE = 32768
+    SCREEN = SymbolTable().get_address("SCREEN")
+    KBD = SymbolTable().get_address("KBD")
+    SCREEN_WORDS = KBD - SCREEN
+    SCREEN_ROWS = 256
+    SIGN_BIT = 0x8000
+    # compiled mode compiles a block the HOT_THRESHOLD-th time its entry is reached
+    HOT_THRESHOLD = 4
+
+    # ALU output for the 6 c-bits of a C-instruction, x is D and y is A or M
+    COMP = {
+        0b101010: lambda x, y: 0,
+        0b111111: lambda x, y: 1,
+        0b111010: lambda x, y: 0xFFFF,
+        0b001100: lambda x, y: x,
+        0b110000: lambda x, y: y,
+        0b001101: lambda x, y: x ^ 0xFFFF,
+        0b110001: lambda x, y: y ^ 0xFFFF,
+        0b001111: lambda x, y: -x & 0xFFFF,
+        0b110011: lambda x, y: -y & 0xFFFF,
+        0b011111: lambda x, y: (x + 1) & 0xFFFF,
+        0b110111: lambda x, y: (y + 1) & 0xFFFF,
+        0b001110: lambda x, y: (x - 1) & 0xFFFF,
+        0b110010: lambda x, y: (y - 1) & 0xFFFF,
+        0b000010: lambda x, y: (x + y) & 0xFFFF,
+        0b010011: lambda x, y: (x - y) & 0xFFFF,
+        0b000111: lambda x, y: (y - x) & 0xFFFF,
+        0b000000: lambda x, y: x & y,
+        0b010101: lambda x, y: x | y,
+    }
+
+    def __init__(self, rom, compiled=False, profile=False, numpy_ram=False):
+        """
+        :param rom: sequence of 16 bit instruction words
+        :param compiled: execute basic blocks compiled to Python functions instead of interpreting
+        :param profile: count executions per ROM address, always interprets
+        :param numpy_ram: back the RAM with an array shared with the NumPy array memory
+        """
+        self.rom = rom
+        if numpy_ram:
+            self.ram = array('H', [0]) * Emulator.RAM_SIZE
+            # shares memory with ram, ram must never be resized
+            self.memory = numpy.frombuffer(self.ram, dtype=numpy.uint16)
+        else:
+            self.ram = [0] * Emulator.RAM_SIZE
+            self.memory = None
+        self.compiled = compiled
+        self._program = Emulator.decode(rom)
+        # entry address -> (function or None, instruction count)
+        self._blocks = {}
+        # entry address -> times interpreted before it gets compiled
+        self._cold = {}
+        self._compiler = BlockCompiler(rom, self._program) if compiled else None
+        self.profiler = Profiler(len(rom)) if profile else None
+        self.reset()
+
+    @staticmethod
+    def from_file(file_name, compiled=False, profile=False, numpy_ram=False):
+        """
+        :param file_name: .hack or .hackb file
+        :param compiled: execute compiled basic blocks
+        :param profile: count executions per ROM address
+        :param numpy_ram: back the RAM with a NumPy array
+        :return:
+        Returns an Emulator loaded with the ROM image
+        """
+        return Emulator(RomFile.load(file_name), compiled, profile, numpy_ram)
+
+    @staticmethod
+    def decode(rom):
+        """
+        Decodes every ROM word once
+
+        :param rom: sequence of 16 bit instruction words
+        :return:
+        Returns one opcode tuple per ROM address followed by a halting sentinel:
+        (OP_A, value) or (OP_C, alu, use_m, dest, jump)
+        """
+        program = []
+        for word in rom:
+            if not word & Emulator.SIGN_BIT:
+                program.append((Emulator.OP_A, word))
+                continue
+            alu = Emulator.COMP.get((word >> 6) & 0x3F)
+            if alu is None:
+                raise Exception("Invalid comp bits in instruction {w:016b}".format(w=word))
+            program.append((Emulator.OP_C, alu, bool(word & 0x1000), (word >> 3) & 7, word & 7))
+        for pc in range(1, len(program)):
+            inst = program[pc]
+            if inst[0] == Emulator.OP_C and inst[4] == 7 and inst[3] == 0 and program[pc - 1] == (Emulator.OP_A, pc - 1):
+                program[pc] = (Emulator.OP_HALT,)
+        program.append((Emulator.OP_HALT,))
+        return program
+
+    def reset(self):
+        """
+        Resets the CPU registers, RAM is left untouched
+        :return:
+        """
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.cycles = 0
+        self.halted = False
+        self.elapsed = 0.0
+
+    def set_key(self, key):
+        """
+        Simulates a key press, 0 releases the key
+        :param key: Hack character code
+        :return:
+        """
+        self.ram[Emulator.KBD] = key
+
+    def screen_words(self):
+        """
+        :return:
+        Returns the 256x32 screen memory map, a live view with numpy_ram and a copy otherwise
+        """
+        if self.memory is None:
+            words = numpy.array(self.ram[Emulator.SCREEN:Emulator.KBD], dtype=numpy.uint16)
+        else:
+            words = self.memory[Emulator.SCREEN:Emulator.KBD]
+        return words.reshape(Emulator.SCREEN_ROWS, -1)
+
+    def screen(self):
+        """
+        :return:
+        Returns the screen as a 256x512 array of 0/1 pixels, pixel (r, c) is bit c % 16 of word 32 * r + c / 16
+        """
+        return Emulator.unpack_screen(self.screen_words())
+
+    @staticmethod
+    def unpack_screen(words):
+        """
+        Unpacks screen words into pixels
+
+        :param words: (..., 256, 32) array of screen words, such as captured frames
+        :return:
+        Returns the matching (..., 256, 512) uint8 array of 0/1 pixels
+        """
+        octets = numpy.ascontiguousarray(words, dtype="<u2").view(numpy.uint8)
+        return numpy.unpackbits(octets, axis=-1, bitorder="little")
+
+    def capture(self, frames, cycles_per_frame):
+        """
+        Runs the program, capturing the screen memory map after every cycles_per_frame instructions.
+        Only the packed screen words are copied into one preallocated buffer, never the whole RAM
+
+        :param frames: number of frames to capture
+        :param cycles_per_frame: instructions executed between captures
+        :return:
+        Returns a (captured, 256, 32) uint16 array of frames, fewer than frames if the program halted
+        """
+        snapshots = numpy.empty((frames, Emulator.SCREEN_ROWS, Emulator.SCREEN_WORDS // Emulator.SCREEN_ROWS),
+                                dtype=numpy.uint16)
+        for frame in range(frames):
+            self.run(cycles_per_frame)
+            snapshots[frame] = self.screen_words()
+            if self.halted:
+                return snapshots[:frame + 1]
+        return snapshots
+
+    def instructions_per_second(self):
+        """
+        :return:
+        Returns the execution speed over every run since the last reset
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return self.cycles / self.elapsed
+
+    def run(self, max_cycles=None):
+        """
+        Executes until the program halts or max_cycles instructions have been executed
+
+        :param max_cycles: instruction budget, None runs until halt
+        :return:
+        Returns the number of instructions executed by this call
+        """
+        if self.halted:
+            return 0
+        budget = sys.maxsize if max_cycles is None else max_cycles
+        start = time.perf_counter()
+        if self.profiler is not None:
+            executed = self._interpret_profiled(budget)
+        elif self.compiled:
+            executed = self._run_blocks(budget)
+        else:
+            executed = self._interpret(budget)
+        self.elapsed += time.perf_counter() - start
+        self.cycles += executed
+        return executed
+
+    def _interpret(self, budget):
+        """
+        Decodes and executes one instruction at a time
+
+        :param budget: maximum number of instructions to execute
+        :return:
+        Returns the number of instructions executed
+        """
+        program = self._program
+        ram = self.ram
+        pc, a, d = self.pc, self.a, self.d
+        executed = 0
+        op_a, op_c = Emulator.OP_A, Emulator.OP_C
+        while executed < budget:
+            inst = program[pc]
+            op = inst[0]
+            if op == op_a:
+                a = inst[1]
+                pc += 1
+            elif op == op_c:
+                _, alu, use_m, dest, jump = inst
+                out = alu(d, ram[a] if use_m else a)
+                target = a
+                if dest:
+                    if dest & 1:
+                        ram[target] = out
+                    if dest & 2:
+                        d = out
+                    if dest & 4:
+                        a = out
+                if jump and (jump == 7 or jump & (4 if out & 0x8000 else (2 if out == 0 else 1))):
+                    pc = target
+                else:
+                    pc += 1
+            else:
+                self.halted = True
+                break
+            executed += 1
+        self.pc, self.a, self.d = pc, a, d
+        return executed
+
+    def _interpret_profiled(self, budget):
+        """
+        Same as _interpret, counting executions per ROM address and taken/not taken jumps in the profiler
+
+        :param budget: maximum number of instructions to execute
+        :return:
+        Returns the number of instructions executed
+        """
+        program = self._program
+        ram = self.ram
+        counts = self.profiler.counts
+        taken = self.profiler.taken
+        not_taken = self.profiler.not_taken
+        pc, a, d = self.pc, self.a, self.d
+        executed = 0
+        op_a, op_c = Emulator.OP_A, Emulator.OP_C
+        while executed < budget:
+            inst = program[pc]
+            op = inst[0]
+            if op == op_a:
+                counts[pc] += 1
+                a = inst[1]
+                pc += 1
+            elif op == op_c:
+                counts[pc] += 1
+                _, alu, use_m, dest, jump = inst
+                out = alu(d, ram[a] if use_m else a)
+                target = a
+                if dest:
+                    if dest & 1:
+                        ram[target] = out
+                    if dest & 2:
+                        d = out
+                    if dest & 4:
+                        a = out
+                if jump and (jump == 7 or jump & (4 if out & 0x8000 else (2 if out == 0 else 1))):
+                    taken[pc] += 1
+                    pc = target
+                else:
+                    if jump:
+                        not_taken[pc] += 1
+                    pc += 1
+            else:
+                self.halted = True
+                break
+            executed += 1
+        self.pc, self.a, self.d = pc, a, d
+        return executed
+
+    def _interpret_to_jump(self, budget):
+        """
+        Same as _interpret, stopping after the first jump instruction whether taken or not
+
+        :param budget: maximum number of instructions to execute
+        :return:
+        Returns the number of instructions executed
+        """
+        program = self._program
+        ram = self.ram
+        pc, a, d = self.pc, self.a, self.d
+        executed = 0
+        op_a, op_c = Emulator.OP_A, Emulator.OP_C
+        while executed < budget:
+            inst = program[pc]
+            op = inst[0]
+            if op == op_a:
+                a = inst[1]
+                pc += 1
+            elif op == op_c:
+                _, alu, use_m, dest, jump = inst
+                out = alu(d, ram[a] if use_m else a)
+                target = a
+                if dest:
+                    if dest & 1:
+                        ram[target] = out
+                    if dest & 2:
+                        d = out
+                    if dest & 4:
+                        a = out
+                executed += 1
+                if jump:
+                    if jump == 7 or jump & (4 if out & 0x8000 else (2 if out == 0 else 1)):
+                        pc = target
+                    else:
+                        pc += 1
+                    break
+                pc += 1
+                continue
+            else:
+                self.halted = True
+                break
+            executed += 1
+        self.pc, self.a, self.d = pc, a, d
+        return executed
+
+    def _run_blocks(self, budget):
+        """
+        Executes compiled basic blocks. Entries reached fewer than HOT_THRESHOLD times are interpreted up
+        to their next jump; halting instructions and a budget shorter than the next block fall back to
+        the interpreter
+
+        :param budget: maximum number of instructions to execute
+        :return:
+        Returns the number of instructions executed
+        """
+        blocks = self._blocks
+        cold = self._cold
+        compiler = self._compiler
+        ram = self.ram
+        pc, a, d = self.pc, self.a, self.d
+        executed = 0
+        while executed < budget:
+            block = blocks.get(pc)
+            if block is None:
+                heat = cold.get(pc, 0) + 1
+                if heat < Emulator.HOT_THRESHOLD:
+                    # compiling costs more than interpreting code that runs only a few times
+                    cold[pc] = heat
+                    self.pc, self.a, self.d = pc, a, d
+                    executed += self._interpret_to_jump(budget - executed)
+                    if self.halted:
+                        return executed
+                    pc, a, d = self.pc, self.a, self.d
+                    continue
+                # any hot entry, including computed jump targets inside other blocks
+                block = blocks[pc] = compiler.compile(pc)
+            function, length = block
+            if function is None or executed + length > budget:
+                self.pc, self.a, self.d = pc, a, d
+                executed += self._interpret(1)
+                if self.halted:
+                    return executed
+                pc, a, d = self.pc, self.a, self.d
+                continue
+            pc, a, d = function(ram, a, d)
+            executed += length
+        self.pc, self.a, self.d = pc, a, d
+        return executed
+
+
+class Profiler:
+    """
+    Hot address profile of an emulator run: executions per ROM address and taken/not taken counts per
+    jump in preallocated arrays, aggregated by the nearest preceding label of the assembler's symbols
+    """
+    # labels of VM functions (Class.function), of the translator's shared routines (VM.Call, VM.Return,
+    # VM.Compare.eq, ...) and of the bootstrap after them (VM.Routines.End), so routine cycles get their
+    # own rows; other internal labels are skipped
+    FUNCTION_LABELS = r"^(VM\.Compare\.[a-z]+|VM\.Routines\.End|[^.$]+\.[^.$]+)$"
+
+    def __init__(self, size):
+        """
+        :param size: number of ROM addresses
+        """
+        self.counts = array('Q', [0]) * size
+        self.taken = array('Q', [0]) * size
+        self.not_taken = array('Q', [0]) * size
+
+    def by_address(self):
+        """
+        :return:
+        Returns (address, cycles, taken, not taken) tuples of the executed addresses, hottest first
+        """
+        counts, taken, not_taken = self.counts, self.taken, self.not_taken
+        report = [(address, counts[address], taken[address], not_taken[address])
+                  for address in range(len(counts)) if counts[address]]
+        report.sort(key=lambda row: row[1], reverse=True)
+        return report
+
+    def by_label(self, symbols, pattern=None):
+        """
+        Aggregates the counts by the nearest label at or before each address
+
+        :param symbols: DebugSymbols of the ROM
+        :param pattern: only labels matching this regular expression are used
+        :return:
+        Returns (label, cycles, taken, not taken) tuples, hottest first; code before the first label is
+        reported under None
+        """
+        if pattern is not None:
+            matcher = re.compile(pattern)
+            labels = dict((label, address) for label, address in symbols.labels.items() if matcher.match(label))
+            symbols = DebugSymbols(symbols.source, labels, symbols.variables, symbols.lines)
+        totals = {}
+        counts, taken, not_taken = self.counts, self.taken, self.not_taken
+        for address in range(len(counts)):
+            if not counts[address]:
+                continue
+            label = symbols.nearest_label(address)
+            total = totals.get(label)
+            if total is None:
+                total = totals[label] = [0, 0, 0]
+            total[0] += counts[address]
+            total[1] += taken[address]
+            total[2] += not_taken[address]
+        report = [(label, total[0], total[1], total[2]) for label, total in totals.items()]
+        report.sort(key=lambda row: row[1], reverse=True)
+        return report
+
+
+class BlockCompiler:
+    """
+    Compiles basic blocks of a ROM into Python functions.
+    A block starts at any address execution reaches and ends at the next conditional or computed jump,
+    running on through unconditional jumps to constant targets. Each block becomes generated source run
+    through exec, called as function(ram, a, d) and returning the next (pc, a, d)
+    """
+    # ALU expression templates for the 6 c-bits, x is D and y is A or M
+    COMP = {
+        0b101010: "0",
+        0b111111: "1",
+        0b111010: "65535",
+        0b001100: "{x}",
+        0b110000: "{y}",
+        0b001101: "{x} ^ 65535",
+        0b110001: "{y} ^ 65535",
+        0b001111: "-{x} & 65535",
+        0b110011: "-{y} & 65535",
+        0b011111: "({x} + 1) & 65535",
+        0b110111: "({y} + 1) & 65535",
+        0b001110: "({x} - 1) & 65535",
+        0b110010: "({y} - 1) & 65535",
+        0b000010: "({x} + {y}) & 65535",
+        0b010011: "({x} - {y}) & 65535",
+        0b000111: "({y} - {x}) & 65535",
+        0b000000: "{x} & {y}",
+        0b010101: "{x} | {y}",
+    }
+    # longest run of instructions compiled into one function
+    MAX_LENGTH = 256
+    # jump condition templates on the ALU output t
+    JUMP = {
+        1: "0 < t < 32768",
+        2: "t == 0",
+        3: "t < 32768",
+        4: "t >= 32768",
+        5: "t != 0",
+        6: "t == 0 or t >= 32768",
+    }
+
+    def __init__(self, rom, program):
+        """
+        :param rom: sequence of 16 bit instruction words
+        :param program: decoded program from Emulator.decode
+        """
+        self._rom = rom
+        self._program = program
+
+    def compile(self, entry):
+        """
+        Compiles the block starting at entry. The block runs on through fall through and through
+        unconditional jumps to constant targets, it ends at the first conditional or computed jump
+
+        :param entry: ROM address
+        :return:
+        Returns (function, instruction count); function is None if the block has to be interpreted
+        """
+        program = self._program
+        if program[entry][0] == Emulator.OP_HALT:
+            return None, 1
+        body = []
+        # value of A when known at compile time
+        known_a = None
+        visited = set()
+        count = 0
+        pc = entry
+        while True:
+            inst = program[pc]
+            if inst[0] == Emulator.OP_HALT or count >= BlockCompiler.MAX_LENGTH:
+                body.append("return {p}, a, d".format(p=pc))
+                break
+            visited.add(pc)
+            count += 1
+            word = self._rom[pc]
+            if inst[0] == Emulator.OP_A:
+                known_a = inst[1]
+                body.append("a = {v}".format(v=known_a))
+                pc += 1
+                continue
+            a_operand = "a" if known_a is None else str(known_a)
+            y = "ram[{a}]".format(a=a_operand) if word & 0x1000 else a_operand
+            expression = BlockCompiler.COMP[(word >> 6) & 0x3F].format(x="d", y=y)
+            dest = (word >> 3) & 7
+            jump = word & 7
+            if jump and jump != 7 or bin(dest).count("1") > 1:
+                body.append("t = " + expression)
+                expression = "t"
+            target = known_a
+            if jump and dest & 4:
+                body.append("target = " + a_operand)
+                a_operand = "target"
+            if dest & 1:
+                body.append("ram[{a}] = {e}".format(a="a" if known_a is None else known_a, e=expression))
+            if dest & 2:
+                body.append("d = " + expression)
+            if dest & 4:
+                body.append("a = " + expression)
+                known_a = None
+            if jump == 7:
+                if target is not None and target not in visited and target < len(self._rom):
+                    # follow the jump, the target's instructions continue this block
+                    pc = target
+                    continue
+                body.append("return {t}, a, d".format(t=a_operand))
+                break
+            if jump:
+                body.append("if {c}:".format(c=BlockCompiler.JUMP[jump]))
+                body.append("    return {t}, a, d".format(t=a_operand))
+                body.append("return {p}, a, d".format(p=pc + 1))
+                break
+            pc += 1
+        source = "def block(ram, a, d):\n    " + "\n    ".join(body) + "\n"
+        namespace = {}
+        exec(compile(source, "<block {e}>".format(e=entry), "exec"), namespace)
+        return namespace["block"], count
+
+
+if __name__ == '__main__':
+    """
+    Entry point of program for execution
+    """
+    parser = argparse.ArgumentParser(description="Runs a Hack ROM image")
+    parser.add_argument("rom", help=".hack or .hackb file")
+    parser.add_argument("--cycles", type=int, default=None, help="maximum number of instructions to execute")
+    parser.add_argument("--jit", action="store_true", help="execute compiled basic blocks")
+    parser.add_argument("--symbols", help="debug symbols sidecar written by the assembler")
+    parser.add_argument("--profile", action="store_true",
+                        help="report the hottest labels, or the hottest addresses without --symbols")
+    parser.add_argument("--top", type=int, default=20, help="number of labels in the profile report")
+    parser.add_argument("--functions", action="store_true", help="aggregate the profile by VM function labels only")
+    args = parser.parse_args()
+    symbols = DebugSymbols.load(args.symbols) if args.symbols else None
+    emulator = Emulator.from_file(args.rom, args.jit, args.profile)
+    emulator.run(args.cycles)
+    print("{c} instructions, {s:.3f}s, {i:.0f} instructions/s{h}".format(
+        c=emulator.cycles, s=emulator.elapsed, i=emulator.instructions_per_second(),
+        h=", halted" if emulator.halted else ""))
+    if args.profile:
+        pattern = Profiler.FUNCTION_LABELS if args.functions else None
+        print("{l:<40} {c:>12} {p:>7} {t:>10} {n:>10}".format(l="label", c="cycles", p="%", t="taken", n="not taken"))
+        if symbols:
+            report = emulator.profiler.by_label(symbols, pattern)
+        else:
+            report = emulator.profiler.by_address()
+        for label, cycles, taken, not_taken in report[:args.top]:
+            print("{l:<40} {c:>12} {p:>6.2f}% {t:>10} {n:>10}".format(
+                l=str(label), c=cycles, p=100.0 * cycles / max(emulator.cycles, 1), t=taken, n=not_taken))
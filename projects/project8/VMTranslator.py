@@ -1,6 +1,15 @@
 import sys
-import re
 import os
+import io
+import argparse
+from functools import lru_cache
+from collections import namedtuple
+
+
+# a parsed VM command, arg1 and arg2 are None where the command type has no such argument.
+# address is pre-resolved for push/pop: the base pointer register of local/argument/this/that, the RAM
+# symbol of temp/pointer/static and the value of constant
+Command = namedtuple("Command", ["type", "arg1", "arg2", "address"])
 
 
 class Parser:
@@ -19,6 +28,8 @@ class Parser:
     C_CALL = "call"
     C_FUNCTION = "function"
     C_RETURN = "return"
+    # if-goto of the negated value, produced by the Optimizer only
+    C_IF_NOT = "if_not_goto"
     IGNORE = "ignore"
     INVALID = "invalid"
     # arithmetic binary operations
@@ -45,6 +56,20 @@ class Parser:
 
     incr = 0
 
+    # keyword -> (command type, number of arguments)
+    DISPATCH = {ADD: (C_ARITHMETIC, 0), SUB: (C_ARITHMETIC, 0), NEG: (C_ARITHMETIC, 0), EQ: (C_ARITHMETIC, 0),
+                GT: (C_ARITHMETIC, 0), LT: (C_ARITHMETIC, 0), AND: (C_ARITHMETIC, 0), OR: (C_ARITHMETIC, 0),
+                NOT: (C_ARITHMETIC, 0), "push": (C_PUSH, 2), "pop": (C_POP, 2), "label": (C_LABEL, 1),
+                "goto": (C_GOTO, 1), "if-goto": (C_IF, 1), "call": (C_CALL, 2), "function": (C_FUNCTION, 2),
+                "return": (C_RETURN, 0)}
+    MEMORY_SEGMENTS = frozenset([ARGUMENT, LOCAL, STATIC, CONSTANT, THIS, THAT, POINTER, TEMP])
+    # segments addressed through a base pointer register
+    SEGMENT_POINTERS = {LOCAL: "LCL", ARGUMENT: "ARG", THIS: "THIS", THAT: "THAT"}
+    POINTER_REGISTERS = {"0": "THIS", "1": "THAT"}
+    TEMP_BASE = 5
+    BLANK = Command(IGNORE, None, None, None)
+    INVALID_COMMAND = Command(INVALID, None, None, None)
+
     def __init__(self, file_name, call_to_sys=False):
         """
         Opens the input file/stream for parsing
@@ -56,7 +81,9 @@ class Parser:
         #CALL TO SYSINIT.0
         if call_to_sys:
             self._lines.insert(0, 'call Sys.init 0')
-        self._line = self._lines[self._current_inst].strip()
+        self._line = self._lines[self._current_inst].strip() if self._lines else ""
+        self._command = Parser.BLANK
+        self.static_prefix = os.path.basename(file_name)
 
     def has_more_commands(self):
         """
@@ -77,7 +104,68 @@ class Parser:
         """
         self._current_inst += 1
         self._line = self._lines[self._current_inst].strip()
-        #print (self._line)
+        self._command = Parser.parse(self._line, self.static_prefix)
+
+    def commands(self):
+        """
+        Iterates over the remaining commands of the input, skipping blank and comment lines
+
+        :return:
+        Returns a generator of Command records
+        """
+        while self.has_more_commands():
+            self.advance()
+            if self._command.type != Parser.IGNORE:
+                yield self._command
+
+    @staticmethod
+    def parse(line, static_prefix=""):
+        """
+        Tokenizes a single line with one split and a lookup in the keyword dispatch table
+
+        :param line: VM source line
+        :param static_prefix: prefix of the static segment symbols, the name of the .vm file
+        :return:
+        Returns the Command record of the line, IGNORE for blank and comment lines and INVALID for
+        unknown keywords, wrong number of arguments, unknown segments or non numeric indexes
+        """
+        tokens = line.split("//", 1)[0].split()
+        if not tokens:
+            return Parser.BLANK
+        entry = Parser.DISPATCH.get(tokens[0])
+        if entry is None or len(tokens) != entry[1] + 1:
+            return Parser.INVALID_COMMAND
+        command_type = entry[0]
+        if command_type == Parser.C_ARITHMETIC:
+            return Command(command_type, tokens[0], None, None)
+        if command_type == Parser.C_PUSH or command_type == Parser.C_POP:
+            segment, index = tokens[1], tokens[2]
+            if not index.isdigit():
+                return Parser.INVALID_COMMAND
+            if segment in Parser.SEGMENT_POINTERS:
+                address = Parser.SEGMENT_POINTERS[segment]
+            elif segment == Parser.CONSTANT and command_type == Parser.C_PUSH:
+                address = index
+            elif segment == Parser.TEMP:
+                address = str(Parser.TEMP_BASE + int(index))
+            elif segment == Parser.STATIC:
+                address = static_prefix + "." + index
+            elif segment == Parser.POINTER and index in Parser.POINTER_REGISTERS:
+                address = Parser.POINTER_REGISTERS[index]
+            else:
+                return Parser.INVALID_COMMAND
+            return Command(command_type, segment, index, address)
+        if (command_type == Parser.C_CALL or command_type == Parser.C_FUNCTION) and not tokens[2].isdigit():
+            return Parser.INVALID_COMMAND
+        return Command(command_type, tokens[1] if len(tokens) > 1 else None, tokens[2] if len(tokens) > 2 else None,
+                       None)
+
+    def command(self):
+        """
+        :return:
+        Returns the Command record of the current line
+        """
+        return self._command
 
     def command_type(self):
         """
@@ -90,29 +178,7 @@ class Parser:
         :return:
         Returns the type of the current VM command
         """
-        if self._is_push_command():
-            command_type = Parser.C_PUSH
-        elif self._is_pop_command():
-            command_type = Parser.C_POP
-        elif self._is_arithmetic_command():
-            command_type = Parser.C_ARITHMETIC
-        elif self._is_label_command():
-            command_type = Parser.C_LABEL
-        elif self._is_goto_command():
-            command_type = Parser.C_GOTO
-        elif self._is_if_command():
-            command_type = Parser.C_IF
-        elif self._is_call_command():
-            command_type = Parser.C_CALL
-        elif self._is_function_command():
-            command_type = Parser.C_FUNCTION
-        elif self._is_return_command():
-            command_type = Parser.C_RETURN
-        elif self._is_comment_line() or self._is_blank_line():
-            command_type = Parser.IGNORE
-        else:
-            command_type = Parser.INVALID
-        return command_type
+        return self._command.type
 
     def arg1(self):
         """
@@ -121,14 +187,9 @@ class Parser:
         Should not be called if the current command is C_RETURN
         :return:
         """
-        commands = [Parser.C_PUSH, Parser.C_POP, Parser.C_LABEL, Parser.C_IF, Parser.C_GOTO, Parser.C_CALL, Parser.C_FUNCTION]
-        if self.command_type() in commands:
-            arg1 = self._line.split()[1]
-        elif self.command_type() == Parser.C_ARITHMETIC:
-            arg1 = self._line.split()[0]
-        else:
+        if self._command.arg1 is None:
             raise Exception("Not to be invoked with any other command")
-        return arg1
+        return self._command.arg1
 
     def arg2(self):
         """
@@ -136,134 +197,151 @@ class Parser:
         Should be called if the current command is C_PUSH, C_POP, C_FUNCTION, C_CALL
         :return:
         """
-        commands = [Parser.C_PUSH, Parser.C_POP, Parser.C_CALL, Parser.C_FUNCTION]
-        if self.command_type() in commands:
-            arg1 = self._line.split()[2]
-        else:
+        if self._command.arg2 is None:
             raise Exception("Not to be invoked with any other command")
-        return arg1
-
-    def _is_push_command(self):
-        """
-        Push command format
-        push local 0
-        :return:
-        """
-        return self._match_memory_pattern("push")
-
-    def _is_pop_command(self):
-        """
-        Pop command format
-        pop local 12
-        :return:
-        """
-        return self._match_memory_pattern("pop")
-
-    def _is_arithmetic_command(self):
-        """
-        Arithmetic command format
-        eg: add
-        :return:
-        """
-        arithmetic_keywords = [Parser.ADD, Parser.SUB, Parser.NEG, Parser.EQ, Parser.GT, Parser.LT, Parser.AND,
-                               Parser.OR, Parser.NOT]
-        for keyword in arithmetic_keywords:
-            pattern = re.compile(r"^(\s)*{k}(\s)*(//(.)*)*$".format(k=keyword))
-            if pattern.search(self._line):
-                return True
-        return False
+        return self._command.arg2
 
-    def _is_comment_line(self):
-        """
-        Any line starting with // with optional blank at beginning is comment line
-        :return:
-        """
-        pattern = re.compile(r"^(\s)*(//)+")
-        return pattern.search(self._line)
 
-    def _is_label_command(self):
-        """
-        label command format
-        eg: label label
-        :return:
-        """
-        pattern = re.compile(r"^(\s)*label(\s)+(\w)+(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+class Optimizer:
+    """
+    VM level pass over the parsed commands of one file, run function by function before code generation:
+    folds constant arithmetic, cancels double not/neg, turns not + if-goto into an inverted branch and
+    drops unreachable commands after goto/return up to the next label
+    """
+    FOLDS = {Parser.ADD: lambda x, y: x + y, Parser.SUB: lambda x, y: x - y, Parser.AND: lambda x, y: x & y,
+             Parser.OR: lambda x, y: x | y}
+    # x + 0, x - 0 and x | 0 are x
+    IDENTITIES = frozenset([Parser.ADD, Parser.SUB, Parser.OR])
+    INVOLUTIONS = frozenset([Parser.NOT, Parser.NEG])
+    # largest value of push constant
+    MAX_CONSTANT = 32767
 
-    def _is_goto_command(self):
-        """
-        goto command format
-        eg: goto label
-        :return:
-        """
-        pattern = re.compile(r"^(\s)*goto(\s)+(\w)+(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+    def __init__(self):
+        self.eliminated = 0
 
-    def _is_if_command(self):
+    def optimize(self, commands):
         """
-        if command format
-        eg: if-goto label
+        :param commands: list of Command records of one .vm file
         :return:
+        Returns the optimized list of Command records
         """
-        pattern = re.compile(r"^(\s)*if-goto(\s)+(\w)+(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+        out = []
+        for function in Optimizer._functions(commands):
+            out.extend(self._optimize_function(function))
+        self.eliminated += len(commands) - len(out)
+        return out
 
-    def _is_call_command(self):
-        """
-        call command format
-        eg: call functionName nArgs
-        :return:
-        """
-        pattern = re.compile(r"^(\s)*call(\s)+(.)+(\d)+(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+    @staticmethod
+    def _functions(commands):
+        """
+        Splits the commands before every function command
+        """
+        function = []
+        for command in commands:
+            if command.type == Parser.C_FUNCTION and function:
+                yield function
+                function = []
+            function.append(command)
+        if function:
+            yield function
 
-    def _is_function_command(self):
-        """
-        call command format
-        eg: function f k
-        :return:
-        """
-        pattern = re.compile(r"^(\s)*function(\s)+(.)+(\d)+(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+    @staticmethod
+    def _optimize_function(commands):
+        out = []
+        reachable = True
+        for command in commands:
+            if not reachable:
+                if command.type != Parser.C_LABEL and command.type != Parser.C_FUNCTION:
+                    continue
+                reachable = True
+            out.append(command)
+            while Optimizer._reduce(out):
+                pass
+            if command.type == Parser.C_GOTO or command.type == Parser.C_RETURN:
+                reachable = False
+        return out
 
-    def _is_return_command(self):
-        """
-        Return command format
-        eg: return
-        :return:
+    @staticmethod
+    def _reduce(out):
         """
-        pattern = re.compile(r"^(\s)*return(\s)*(//(.)*)*$")
-        return pattern.search(self._line)
+        Rewrites the tail of the optimized commands once
 
-    def _is_blank_line(self):
-        """
-        Any line starting with empty white space
+        :param out: optimized commands so far
         :return:
-        """
-        pattern = re.compile(r"^(\s)*$")
-        return pattern.search(self._line)
-
-    def _match_memory_pattern(self, command_prefix):
-        memory_segments = [Parser.ARGUMENT, Parser.LOCAL, Parser.STATIC, Parser.CONSTANT, Parser.THIS, Parser.THAT, Parser.POINTER, Parser.TEMP]
-        for segment in memory_segments:
-            pattern = re.compile(r"^(\s)*{c}(\s)+{s}(\s)+(\d)+(\s)*(//(.)*)*$".format(c=command_prefix, s=segment))
-            if pattern.search(self._line):
+        Returns true if the tail was rewritten
+        """
+        if len(out) < 2:
+            return False
+        last, previous = out[-1], out[-2]
+        if last.type == Parser.C_ARITHMETIC:
+            if previous.type == Parser.C_ARITHMETIC and last.arg1 == previous.arg1 and last.arg1 in Optimizer.INVOLUTIONS:
+                del out[-2:]
+                return True
+            if not Optimizer._is_constant(previous):
+                return False
+            if last.arg1 in Optimizer.IDENTITIES and previous.arg2 == "0":
+                del out[-2:]
                 return True
+            if last.arg1 in Optimizer.FOLDS and len(out) > 2 and Optimizer._is_constant(out[-3]):
+                value = Optimizer.FOLDS[last.arg1](int(out[-3].arg2), int(previous.arg2))
+                if 0 <= value <= Optimizer.MAX_CONSTANT:
+                    out[-3:] = [Command(Parser.C_PUSH, Parser.CONSTANT, str(value), str(value))]
+                    return True
+        elif last.type == Parser.C_IF and previous.type == Parser.C_ARITHMETIC and previous.arg1 == Parser.NOT:
+            out[-2:] = [Command(Parser.C_IF_NOT, last.arg1, None, None)]
+            return True
         return False
 
+    @staticmethod
+    def _is_constant(command):
+        return command.type == Parser.C_PUSH and command.arg1 == Parser.CONSTANT
+
 
 class CodeWriter:
     """
     Translates VM commands into Hack assembly code
     """
+    BINARY_OPS = frozenset([Parser.ADD, Parser.SUB, Parser.AND, Parser.OR, Parser.EQ, Parser.LT, Parser.GT])
+    # eq/lt/gt emit unique labels, their assembly can't be reused
+    COMPARISONS = frozenset([Parser.EQ, Parser.LT, Parser.GT])
+    # jump taken on y - x when the comparison x op y holds
+    COMPARISON_JUMPS = {Parser.EQ: "JEQ", Parser.LT: "JGT", Parser.GT: "JLT"}
+    # number of finished assembly blocks kept for reuse
+    CACHE_SIZE = 1024
+    # base pointer segment addresses up to this index are reached with A=A+1 steps instead of D=index
+    MAX_UNROLLED_INDEX = 7
+    # fast frames zero up to this many locals with straight-line code instead of a loop
+    MAX_UNROLLED_LOCALS = 8
 
-    def __init__(self, output_file):
+    # labels of the shared call/return routines
+    CALL_ROUTINE = "VM.Call"
+    RETURN_ROUTINE = "VM.Return"
+    COMPARE_ROUTINE = "VM.Compare.{c}"
+    ROUTINES_END = "VM.Routines.End"
+
+    def __init__(self, output_file, trampolines=False, shared_comparisons=False, peephole=False, fast_frames=False):
         """
         Opens the output file/stream and gets ready to write into it
         :param output_file:
-        """
-        self.file = open(output_file, "w")
+        :param trampolines: calls and returns jump to a single shared routine instead of inlining it
+        :param shared_comparisons: eq/lt/gt jump to one shared routine per comparison instead of inlining it
+        :param peephole: buffer the assembly and run the Peephole pass over it on close
+        :param fast_frames: calling convention with unrolled local initialization, R13/R14 scratch registers
+        and frames saved and restored by pointer walks
+        """
+        # the peephole pass needs the whole program, the output is written on close
+        self.file = io.StringIO() if peephole else open(output_file, "w")
         self.output_file = output_file
+        self.peephole = Peephole() if peephole else None
+        self.trampolines = trampolines
+        self.shared_comparisons = shared_comparisons
+        self.fast_frames = fast_frames
+        self._routines_written = False
+        # unique index of every call site across all files, keeps return address labels unique
+        self._call_index = 0
+        # Command -> assembly text of push/pop and label free arithmetic commands. The Command record
+        # holds the command, segment, index and resolved static symbol (so the file) of the key
+        self._cached_text = lru_cache(maxsize=CodeWriter.CACHE_SIZE)(self._text)
 
     def set_filename(self, file_name):
         """
@@ -276,12 +354,27 @@ class CodeWriter:
     def write_arithmetic(self, command):
         """
         Writes the assembly code that is the translation of the given arithmetic command
-        :param command:
+        :param command: C_ARITHMETIC Command
         :return:
         """
-        option = command.split(',')[1]
-        binary_op = [Parser.ADD, Parser.SUB, Parser.AND, Parser.OR, Parser.EQ, Parser.LT, Parser.GT]
-        if option in binary_op:
+        if command.arg1 in CodeWriter.COMPARISONS:
+            if self.shared_comparisons:
+                return self._print(self._shared_comparison(command.arg1))
+            return self._print(self._arithmetic(command))
+        self.file.write(self._cached_text(command))
+
+    def _shared_comparison(self, option):
+        """
+        Call site of a shared comparison routine, D carries the return address
+        """
+        incr = Parser.incr
+        Parser.incr += 1
+        return ["@COMPARE{i}".format(i=incr), "D=A", "@{r}".format(r=CodeWriter.COMPARE_ROUTINE.format(c=option)),
+                "0;JMP", "(COMPARE{i})".format(i=incr)]
+
+    def _arithmetic(self, command):
+        option = command.arg1
+        if option in CodeWriter.BINARY_OPS:
             init = self._decr_stack_pointer() + self._set_D("SP", "M") + self._decr_stack_pointer()
         else:
             init = self._decr_stack_pointer()
@@ -307,148 +400,145 @@ class CodeWriter:
             spec = self._set_logical_op("JLT", Parser.incr)
             Parser.incr += 1
         final = self._incr_stack_pointer()
-        return self._print(init + spec + final)
+        return init + spec + final
 
     def write_pushpop(self, command):
         """
         Writes the assembly code that is the translation of the given command where command is
         C_PUSH or C_POP
-        :param command:
+        :param command: C_PUSH or C_POP Command with its pre-resolved address
+        :return:
+        """
+        self.file.write(self._cached_text(command))
+
+    def _text(self, command):
+        """
+        :param command: push/pop or label free arithmetic Command
         :return:
+        Returns the assembly of the command as a single block of text
         """
-        commands = command.split(',')
-        command_type = commands[0]
-        vir_mem = commands[1]
-        offset = commands[2]
-        file_name = commands[3]
-        vm_assembly_map = {Parser.LOCAL: "LCL", Parser.ARGUMENT: "ARG", Parser.THIS: "THIS", Parser.THAT: "THAT"}
-        if command_type == Parser.C_PUSH and vir_mem in vm_assembly_map:
+        if command.type == Parser.C_ARITHMETIC:
+            lines = self._arithmetic(command)
+        else:
+            lines = self._pushpop(command)
+        return "\n".join(lines) + "\n"
+
+    def cache_stats(self):
+        """
+        :return:
+        Returns the hits, misses, size and hit rate of the assembly text cache
+        """
+        info = self._cached_text.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+                "hit_rate": float(info.hits) / lookups if lookups else 0.0}
+
+    def _pushpop(self, command):
+        if command.type == Parser.C_PUSH and command.arg1 in Parser.SEGMENT_POINTERS:
             # D register gets value of the vir mem seg
-            c1 = self._set_D_A(offset)
-            c2 = ["@{s}".format(s=vm_assembly_map[vir_mem]), "A=D+M", "D=M"]
+            c1 = self._set_D_A(command.arg2)
+            c2 = ["@{s}".format(s=command.address), "A=D+M", "D=M"]
             # stack gets value from D
             c3 = self._set_stack("D")
             # incrementing stack to point to next address
             c4 = self._incr_stack_pointer()
-            return self._print(c1 + c2 + c3 +c4)
-        elif command_type == Parser.C_PUSH and vir_mem == Parser.CONSTANT:
+            return c1 + c2 + c3 + c4
+        elif command.type == Parser.C_PUSH and command.arg1 == Parser.CONSTANT:
             # assign stack to have the constant value
-            c1 = self._set_D_A(offset)
+            c1 = self._set_D_A(command.address)
             c2 = self._set_stack("D")
             # incrementing stack to point to next address
             c3 = self._incr_stack_pointer()
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_PUSH and vir_mem == Parser.TEMP:
-            offset = str(5 + int(offset))
-            c1 = ["@{o}".format(o=offset), "D=M"]
+            return c1 + c2 + c3
+        elif command.type == Parser.C_PUSH:
+            # temp, static and pointer are read directly from their RAM symbol
+            c1 = ["@{o}".format(o=command.address), "D=M"]
             # stack gets value from D
             c2 = self._set_stack("D")
             # incrementing stack to point to next address
             c3 = self._incr_stack_pointer()
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_PUSH and vir_mem == Parser.STATIC:
-            paths = file_name.split("/")
-            file_name = paths[len(paths)-1]
-            offset = '.'.join([file_name, offset])
-            c1 = ["@{o}".format(o=offset), "D=M"]
-            # stack gets value from D
-            c2 = self._set_stack("D")
-            # incrementing stack to point to next address
-            c3 = self._incr_stack_pointer()
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_PUSH and vir_mem == Parser.POINTER:
-            offset_dict = {"0": "THIS", "1": "THAT"}
-            val = offset_dict[offset]
-            # *SP = THIS/THAT
-            c1 = ["@{v}".format(v=val), "D=M"]
-            c2 = self._set_stack("D")
-            # incrementing stack to point to next address
-            c3 = self._incr_stack_pointer()
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_POP and vir_mem in vm_assembly_map:
+            return c1 + c2 + c3
+        elif command.type == Parser.C_POP and command.arg1 in Parser.SEGMENT_POINTERS:
             # decrement stack pointer and place contents of the stack in D register
             c1 = self._decr_stack_pointer()
             # D now stores the RAM address of where info needs to be stored
-            c2 = ["@{o}".format(o=offset), "D=A", "@{s}".format( s=vm_assembly_map[vir_mem]),"D=D+M"]
+            c2 = ["@{o}".format(o=command.arg2), "D=A", "@{s}".format(s=command.address), "D=D+M"]
             # D stores address where info needs to be stored  and value of stack
             c3 = ["@SP", "A=M", "D=D+M"]
             # go to address stored in previous M
             c4 = ["A=D-M"]
             # place value in address from D and A
             c5 = ["M=D-A"]
-            return self._print(c1 + c2 + c3 + c4 + c5)
-        elif command_type == Parser.C_POP and vir_mem == Parser.TEMP:
-            # decrement stack pointer and place contents of the stack in D register
-            c1 = self._decr_stack_pointer()
-            c2 = ["@SP", "A=M", "D=M"]
-            offset = str(5 + int(offset))
-            # store in temp segment from D register
-            c3 = ["@{o}".format(o=offset), "M=D"]
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_POP and vir_mem == Parser.STATIC:
+            return c1 + c2 + c3 + c4 + c5
+        elif command.type == Parser.C_POP and command.address is not None:
             # decrement stack pointer and place contents of the stack in D register
             c1 = self._decr_stack_pointer()
             c2 = ["@SP", "A=M", "D=M"]
-            paths = file_name.split("/")
-            file_name = paths[len(paths)-1]
-            offset = '.'.join([file_name, offset])
-            # store in temp segment from D register
-            c3 = ["@{o}".format(o=offset), "M=D"]
-            return self._print(c1 + c2 + c3)
-        elif command_type == Parser.C_POP and vir_mem == Parser.POINTER:
-            # SP --
-            # THIS/THAT = *SP
-            offset_dict = {"0": "THIS", "1": "THAT"}
-            val = offset_dict[offset]
-            # decrement stack pointer and place contents of the stack in D register
-            c1 = self._decr_stack_pointer()
-            c2 = ["@SP", "A=M", "D=M"]
-            c3 = ["@{v}".format(v= val), "M=D"]
-            return self._print(c1 + c2 + c3)
+            # store in temp/static/pointer segment from D register
+            c3 = ["@{o}".format(o=command.address), "M=D"]
+            return c1 + c2 + c3
         raise Exception("Invalid push/pop command")
 
     def write_label(self, command):
         """
         Writes the assembly code that affects the label command
         C_LABEL
-        :param command:
+        :param command: C_LABEL Command
         :return:
         """
-        label = command.split(",")[1]
-        return self._print(["({lb})".format(lb=label)])
+        return self._print(["({lb})".format(lb=command.arg1)])
 
     def write_goto(self, command):
         """
         Writes assembly code that affects the goto command
-        :param command:
+        :param command: C_GOTO Command
         :return:
         """
-        label = command.split(",")[1]
-        return self._print(["@{v}".format(v=label), "0;JMP"])
+        return self._print(["@{v}".format(v=command.arg1), "0;JMP"])
 
     def write_if(self, command):
         """
         Writes assembly code that affects the if-goto command
-        :param command:
+        :param command: C_IF or C_IF_NOT Command
         :return:
         """
-        label = command.split(",")[1]
         c1 = self._decr_stack_pointer()
         c2 = self._set_D("SP", "M")
-        c3 = ["@{lb}".format(lb=label), "D;JLT", "D;JGT"]
+        if command.type == Parser.C_IF_NOT:
+            # not x is false only for x = true (-1)
+            c3 = ["D=D+1", "@{lb}".format(lb=command.arg1), "D;JNE"]
+        else:
+            c3 = ["@{lb}".format(lb=command.arg1), "D;JLT", "D;JGT"]
         return self._print(c1 + c2 + c3)
 
-    def write_call(self, function, num_args):
+    def write_call(self, command):
         """
         Writes assembly code that affects the call command
-        :param function_name:
-        :param num_args:
+        :param command: C_CALL Command, function name and number of arguments
         :return:
         """
-        function_name = function.split(",")[0]
-        incr = function.split(",")[1]
+        function_name = command.arg1
+        num_args = command.arg2
+        return_address = "return.address.{f}.{i}".format(f=function_name, i=self._call_index)
+        self._call_index += 1
+        if self.fast_frames:
+            # fast frames pass n + 5, the routine or the call site subtracts it from SP at once
+            num_args = int(num_args) + 5
+        if self.trampolines:
+            # R13 = n, R14 = f, D = return address, goto the shared call routine
+            c1 = ["@{n}".format(n=num_args), "D=A", "@R13", "M=D"]
+            c2 = ["@{f}".format(f=function_name), "D=A", "@R14", "M=D"]
+            c3 = ["@{r}".format(r=return_address), "D=A", "@{c}".format(c=CodeWriter.CALL_ROUTINE), "0;JMP"]
+            c4 = ["({r})".format(r=return_address)]
+            return self._print(c1 + c2 + c3 + c4)
+        if self.fast_frames:
+            c1 = ["@{r}".format(r=return_address), "D=A"] + self._push_frame()
+            # ARG = SP - n - 5
+            c2 = ["@{n}".format(n=num_args), "D=D-A", "@ARG", "M=D"]
+            c3 = ["@{f}".format(f=function_name), "0;JMP", "({r})".format(r=return_address)]
+            return self._print(c1 + c2 + c3)
         # push return address
-        c1 = ["@return.address.{f}.{i}".format(f=function_name, i=incr), "D=A"]
+        c1 = ["@{r}".format(r=return_address), "D=A"]
         c2 = self._set_stack("D")
         c3 = self._incr_stack_pointer()
         # push LCL
@@ -466,16 +556,19 @@ class CodeWriter:
         # goto f
         c10 = ["@{f}".format(f=function_name), "0;JMP"]
         # declare label for return address
-        c11 = ["(return.address.{f}.{i})".format(f=function_name, i=incr)]
+        c11 = ["({r})".format(r=return_address)]
         return self._print(c1 + c2 + c3 + c4 + c5 + c6 + c7 + c8 + c9 + c10 + c11)
 
-    def write_function(self, function_name, num_args):
+    def write_function(self, command):
         """
         Writes assembly code that effects the call command
-        :param function_name:
-        :param num_args:
+        :param command: C_FUNCTION Command, function name and number of locals
         :return:
         """
+        function_name = command.arg1
+        num_args = command.arg2
+        if self.fast_frames and int(num_args) <= CodeWriter.MAX_UNROLLED_LOCALS:
+            return self._print(["({f})".format(f=function_name)] + self._zero_locals(int(num_args)))
         # declare a label for the function entry
         c1 = ["({f})".format(f=function_name)]
         c2 = ["@{n}".format(n=num_args), "D=A"]
@@ -490,11 +583,24 @@ class CodeWriter:
         c10 = ["(End.Local.{f})".format(f=function_name)]
         return self._print(c1 + c2 + c3 + c4 + c5 + c6 + c7 + c8 + c9 +c10)
 
+    @staticmethod
+    def _zero_locals(count):
+        """
+        Pushes count zeros walking A up the stack, then SP = A + 1
+        """
+        if count == 0:
+            return []
+        return ["@SP", "A=M", "M=0"] + ["A=A+1", "M=0"] * (count - 1) + ["D=A+1", "@SP", "M=D"]
+
     def write_return(self):
         """
         Writes assembly code that affects the return command
         :return:
         """
+        if self.trampolines:
+            return self._print(["@{r}".format(r=CodeWriter.RETURN_ROUTINE), "0;JMP"])
+        if self.fast_frames:
+            return self._print(self._pop_frame())
         # assign frame to lcl
         c1 =  ["@LCL", "D=M","@frame", "M=D"]
         # assign return address to temp
@@ -539,6 +645,81 @@ class CodeWriter:
         c10 = ["@THAT", "M=D"]
         return self._print(c1 + c2 + c3 + c4 + c5 + c6 + c7 + c8 + c9 + c10)
 
+    def write_routines(self):
+        """
+        Writes the shared call/return and comparison routines of the enabled modes once, behind a jump
+        over them
+        :return:
+        """
+        if not (self.trampolines or self.shared_comparisons) or self._routines_written:
+            return
+        self._routines_written = True
+        routines = ["@{e}".format(e=CodeWriter.ROUTINES_END), "0;JMP"]
+        if self.trampolines:
+            routines += self._call_return_routines()
+        if self.shared_comparisons:
+            for option in (Parser.EQ, Parser.LT, Parser.GT):
+                routines += self._comparison_routine(option)
+        return self._print(routines + ["({e})".format(e=CodeWriter.ROUTINES_END)])
+
+    def _comparison_routine(self, option):
+        """
+        Shared eq/lt/gt: D = return address, saved in R13; pops y, replaces x with the result
+        """
+        name = CodeWriter.COMPARE_ROUTINE.format(c=option)
+        # D = y - x, x assumed true
+        c1 = ["({n})".format(n=name), "@R13", "M=D", "@SP", "AM=M-1", "D=M", "A=A-1", "D=D-M", "M=-1"]
+        c2 = ["@{n}.End".format(n=name), "D;{j}".format(j=CodeWriter.COMPARISON_JUMPS[option])]
+        c3 = ["@SP", "A=M-1", "M=0"]
+        c4 = ["({n}.End)".format(n=name), "@R13", "A=M", "0;JMP"]
+        return c1 + c2 + c3 + c4
+
+    def _call_return_routines(self):
+        """
+        Shared call and return of the trampolines mode
+        """
+        # call: D = return address, R13 = number of arguments (plus 5 with fast frames), R14 = function address
+        c1 = ["({c})".format(c=CodeWriter.CALL_ROUTINE)] + self._push_frame()
+        # ARG = SP - n - 5
+        if self.fast_frames:
+            c2 = ["@R13", "D=D-M", "@ARG", "M=D"]
+        else:
+            c2 = ["@R13", "D=D-M", "@5", "D=D-A", "@ARG", "M=D"]
+        # goto f
+        c3 = ["@R14", "A=M", "0;JMP"]
+        c4 = ["({r})".format(r=CodeWriter.RETURN_ROUTINE)] + self._pop_frame()
+        return c1 + c2 + c3 + c4
+
+    @staticmethod
+    def _push_frame():
+        """
+        Pushes the return address in D and LCL, ARG, THIS, THAT walking SP once, then LCL = SP.
+        Leaves D = SP
+        """
+        c1 = ["@SP", "A=M", "M=D"]
+        c2 = []
+        for symbol in ("LCL", "ARG", "THIS", "THAT"):
+            c2 += ["@{s}".format(s=symbol), "D=M", "@SP", "AM=M+1", "M=D"]
+        c3 = ["@SP", "MD=M+1", "@LCL", "M=D"]
+        return c1 + c2 + c3
+
+    @staticmethod
+    def _pop_frame():
+        """
+        Returns to the caller with R13 = frame and R14 = return address, restoring THAT, THIS, ARG, LCL
+        by walking R13 down the frame
+        """
+        c1 = ["@LCL", "D=M", "@R13", "M=D", "@5", "A=D-A", "D=M", "@R14", "M=D"]
+        # *ARG = pop, SP = ARG + 1
+        c2 = ["@SP", "AM=M-1", "D=M", "@ARG", "A=M", "M=D", "D=A+1", "@SP", "M=D"]
+        # THAT, THIS, ARG, LCL = *(frame - 1 ... 4)
+        c3 = []
+        for symbol in ("THAT", "THIS", "ARG", "LCL"):
+            c3 += ["@R13", "AM=M-1", "D=M", "@{s}".format(s=symbol), "M=D"]
+        # goto return address
+        c4 = ["@R14", "A=M", "0;JMP"]
+        return c1 + c2 + c3 + c4
+
     def _assign_symbols(self, temp, incr, symbol):
         return ["@{f}".format(f =temp), "D=M", "@{i}".format(i =incr), "D=D-A", "A=D", "D=M", "@{s}".format(s = symbol), "M=D"]
 
@@ -554,6 +735,10 @@ class CodeWriter:
             self.file.write(c + "\n")
 
     def close(self):
+        if self.peephole is not None:
+            lines = self.peephole.optimize(self.file.getvalue().splitlines())
+            with open(self.output_file, "w") as f:
+                f.write("".join(line + "\n" for line in lines))
         self.file.close()
 
     def _incr_stack_pointer(self):
@@ -613,25 +798,306 @@ class CodeWriter:
         """
         return ["@{o}", "D=A", "@{a}".format(a=virmem), "A=M+D".format(o=offset), "M=D"]
 
+    @staticmethod
+    def _segment_address(symbol, index):
+        """
+        A = symbol + index without touching D
+        @:symbol: LCL/ARG/THIS/THAT
+        """
+        if index == 0:
+            return ["@{s}".format(s=symbol), "A=M"]
+        return ["@{s}".format(s=symbol), "A=M+1"] + ["A=A+1"] * (index - 1)
+
     def set_end(self):
         return self._print(["(END)", "@END", "0;JMP" ])
 
 
+class StackCachingCodeWriter(CodeWriter):
+    """
+    CodeWriter that keeps the top of the stack in the D register across straight-line VM code.
+    While the top is cached SP points to the slot it would be stored in. Labels, jumps, calls and returns
+    expect the whole stack in RAM, the cached top is spilled before them
+    """
+    # *SP = D, SP++
+    SPILL = ["@SP", "AM=M+1", "A=A-1", "M=D"]
+    # SP--, D = *SP
+    FILL = ["@SP", "AM=M-1", "D=M"]
+    # D = x op y with y in D and x at the new top of the RAM stack
+    BINARY = {Parser.ADD: "D=D+M", Parser.SUB: "D=M-D", Parser.AND: "D=D&M", Parser.OR: "D=D|M"}
+    UNARY = {Parser.NEG: "D=-D", Parser.NOT: "D=!D"}
+
+    def __init__(self, output_file, trampolines=False, shared_comparisons=False, peephole=False, fast_frames=False):
+        CodeWriter.__init__(self, output_file, trampolines, shared_comparisons, peephole, fast_frames)
+        # true while the top of the stack is in D
+        self.cached = False
+
+    def _spill(self):
+        if not self.cached:
+            return []
+        self.cached = False
+        return StackCachingCodeWriter.SPILL
+
+    def write_arithmetic(self, command):
+        """
+        Writes the arithmetic command on the cached top, the result stays in D
+        :param command: C_ARITHMETIC Command
+        :return:
+        """
+        if command.arg1 in CodeWriter.COMPARISONS and self.shared_comparisons:
+            return self._print(self._spill() + self._shared_comparison(command.arg1))
+        if command.arg1 in CodeWriter.COMPARISONS:
+            fill = [] if self.cached else StackCachingCodeWriter.FILL
+            incr = Parser.incr
+            Parser.incr += 1
+            # D = y - x
+            c1 = ["@SP", "AM=M-1", "D=D-M"]
+            c2 = ["@TRUE{i}".format(i=incr), "D;{c}".format(c=CodeWriter.COMPARISON_JUMPS[command.arg1])]
+            c3 = ["D=0", "@ACOND{i}".format(i=incr), "0;JMP"]
+            c4 = ["(TRUE{i})".format(i=incr), "D=-1", "(ACOND{i})".format(i=incr)]
+            self._print(fill + c1 + c2 + c3 + c4)
+        else:
+            self.file.write(self._cached_text(command, self.cached))
+        self.cached = True
+
+    def write_pushpop(self, command):
+        """
+        push spills the cached top and loads the value into D, pop stores D
+        :param command: C_PUSH or C_POP Command with its pre-resolved address
+        :return:
+        """
+        self.file.write(self._cached_text(command, self.cached))
+        self.cached = command.type == Parser.C_PUSH
+
+    def _text(self, command, cached=False):
+        """
+        :param command: push/pop or label free arithmetic Command
+        :param cached: the top of the stack is in D before the command
+        :return:
+        Returns the assembly of the command as a single block of text
+        """
+        if command.type == Parser.C_PUSH:
+            lines = (StackCachingCodeWriter.SPILL if cached else []) + self._load(command)
+        else:
+            lines = ([] if cached else StackCachingCodeWriter.FILL) + self._operate(command)
+        return "\n".join(lines) + "\n"
+
+    def _load(self, command):
+        """
+        D = value of the push command
+        """
+        if command.arg1 == Parser.CONSTANT:
+            return self._set_D_A(command.address)
+        if command.arg1 not in Parser.SEGMENT_POINTERS:
+            return ["@{a}".format(a=command.address), "D=M"]
+        index = int(command.arg2)
+        if index <= 2:
+            return CodeWriter._segment_address(command.address, index) + ["D=M"]
+        return self._set_D_A(command.arg2) + ["@{s}".format(s=command.address), "A=D+M", "D=M"]
+
+    def _operate(self, command):
+        """
+        Applies a pop or a label free arithmetic command to the value in D
+        """
+        if command.type == Parser.C_ARITHMETIC:
+            if command.arg1 in StackCachingCodeWriter.UNARY:
+                return [StackCachingCodeWriter.UNARY[command.arg1]]
+            return ["@SP", "AM=M-1", StackCachingCodeWriter.BINARY[command.arg1]]
+        if command.arg1 not in Parser.SEGMENT_POINTERS:
+            return ["@{a}".format(a=command.address), "M=D"]
+        index = int(command.arg2)
+        if index <= CodeWriter.MAX_UNROLLED_INDEX:
+            return CodeWriter._segment_address(command.address, index) + ["M=D"]
+        # park the value in the free slot at SP while D computes the address
+        c1 = ["@SP", "A=M", "M=D"]
+        c2 = ["@{o}".format(o=command.arg2), "D=A", "@{s}".format(s=command.address), "D=D+M"]
+        c3 = ["@SP", "A=M", "D=D+M", "A=D-M", "M=D-A"]
+        return c1 + c2 + c3
+
+    def write_label(self, command):
+        self._print(self._spill())
+        return CodeWriter.write_label(self, command)
+
+    def write_goto(self, command):
+        self._print(self._spill())
+        return CodeWriter.write_goto(self, command)
+
+    def write_if(self, command):
+        """
+        Branches on the cached top
+        :param command: C_IF or C_IF_NOT Command
+        :return:
+        """
+        fill = [] if self.cached else StackCachingCodeWriter.FILL
+        self.cached = False
+        if command.type == Parser.C_IF_NOT:
+            # not x is false only for x = true (-1)
+            return self._print(fill + ["D=D+1", "@{lb}".format(lb=command.arg1), "D;JNE"])
+        return self._print(fill + ["@{lb}".format(lb=command.arg1), "D;JNE"])
+
+    def write_call(self, command):
+        self._print(self._spill())
+        return CodeWriter.write_call(self, command)
+
+    def write_function(self, command):
+        self._print(self._spill())
+        return CodeWriter.write_function(self, command)
+
+    def write_return(self):
+        self._print(self._spill())
+        return CodeWriter.write_return(self)
+
+    def set_end(self):
+        self._print(self._spill())
+        return CodeWriter.set_end(self)
+
+
+class Peephole:
+    """
+    Post-pass over the emitted assembly that rewrites short instruction windows into cheaper equivalents:
+    push then pop pairs become direct moves through D, SP increment/decrement pairs are removed and
+    redundant reloads are dropped. Windows never span a label, so no jump target is affected.
+    Rules are applied left to right and the pass repeats until nothing changes
+    """
+    # *SP = D, SP++
+    PUSH_D = ["@SP", "A=M", "M=D", "@SP", "M=M+1"]
+    # SP--, D = *SP
+    POP_D = ["@SP", "M=M-1", "@SP", "A=M", "D=M"]
+    SEGMENT_POINTERS = frozenset(["LCL", "ARG", "THIS", "THAT"])
+
+    def __init__(self):
+        self.removed = 0
+
+    def optimize(self, lines):
+        """
+        :param lines: assembly lines
+        :return:
+        Returns the optimized assembly lines
+        """
+        rules = [self._push_pop_segment, self._push_pop_d, self._push_segment_base, self._stack_pointer_pair,
+                 self._stack_reload, self._store_load]
+        before = len(lines)
+        changed = True
+        while changed:
+            changed = False
+            out = []
+            i = 0
+            size = len(lines)
+            while i < size:
+                for rule in rules:
+                    match = rule(lines, i)
+                    if match is not None:
+                        consumed, replacement = match
+                        out.extend(replacement)
+                        i += consumed
+                        changed = True
+                        break
+                else:
+                    out.append(lines[i])
+                    i += 1
+            lines = out
+        self.removed += before - len(lines)
+        return lines
+
+    @staticmethod
+    def _push_pop_d(lines, i):
+        """
+        push then pop into D: the value is already in D, the stack round trip and its store are dropped
+        """
+        if lines[i] != "@SP" or lines[i:i + 10] != Peephole.PUSH_D + Peephole.POP_D:
+            return None
+        # the following code must reload A
+        if i + 10 >= len(lines) or not lines[i + 10].startswith("@"):
+            return None
+        return 10, []
+
+    @staticmethod
+    def _push_pop_segment(lines, i):
+        """
+        push then pop to local/argument/this/that with a small index: store D through the base pointer
+        """
+        if lines[i] != "@SP" or lines[i:i + 7] != Peephole.PUSH_D + ["@SP", "M=M-1"]:
+            return None
+        window = lines[i + 7:i + 16]
+        if len(window) < 9 or window[1] != "D=A" or window[3:] != ["D=D+M", "@SP", "A=M", "D=D+M", "A=D-M", "M=D-A"]:
+            return None
+        index, segment = window[0][1:], window[2][1:]
+        if not index.isdigit() or int(index) > CodeWriter.MAX_UNROLLED_INDEX or segment not in Peephole.SEGMENT_POINTERS:
+            return None
+        return 16, CodeWriter._segment_address(segment, int(index)) + ["M=D"]
+
+    @staticmethod
+    def _push_segment_base(lines, i):
+        """
+        D = *(segment + 0 or 1) without going through D = index
+        """
+        if lines[i] not in ("@0", "@1") or lines[i + 1:i + 2] != ["D=A"] or lines[i + 3:i + 5] != ["A=D+M", "D=M"]:
+            return None
+        segment = lines[i + 2][1:]
+        if segment not in Peephole.SEGMENT_POINTERS:
+            return None
+        return 5, ["@" + segment, "A=M" if lines[i] == "@0" else "A=M+1", "D=M"]
+
+    @staticmethod
+    def _stack_pointer_pair(lines, i):
+        """
+        SP++ then SP-- or SP-- then SP++ cancel out
+        """
+        if lines[i] != "@SP" or lines[i + 2:i + 3] != ["@SP"]:
+            return None
+        pair = (lines[i + 1], lines[i + 3] if i + 3 < len(lines) else None)
+        if pair == ("M=M+1", "M=M-1") or pair == ("M=M-1", "M=M+1"):
+            return 4, []
+        return None
+
+    @staticmethod
+    def _stack_reload(lines, i):
+        """
+        A already holds *SP after a store through it
+        """
+        if lines[i] != "@SP" or lines[i:i + 5] != ["@SP", "A=M", "M=D", "@SP", "A=M"]:
+            return None
+        return 5, ["@SP", "A=M", "M=D"]
+
+    @staticmethod
+    def _store_load(lines, i):
+        """
+        D already holds M after M=D
+        """
+        if lines[i] != "M=D" or lines[i + 1:i + 2] != ["D=M"]:
+            return None
+        return 2, ["M=D"]
+
+
 class Driver:
     """
     Class to drive program execution
 
     """
     @staticmethod
-    def check_dir():
-        path = str(sys.argv[1])
+    def check_dir(path, trampolines=False, shared_comparisons=False, peephole=False, optimizer=None,
+                  cache_top=False, fast_frames=False):
+        """
+        Translates a .vm file or every .vm file of a directory
+
+        :param path: .vm file or directory
+        :param trampolines: share a single call and return routine between all call sites
+        :param shared_comparisons: share one eq, lt and gt routine between all comparisons
+        :param peephole: run the Peephole pass over the generated assembly
+        :param optimizer: Optimizer run over the VM commands of every file, None to translate them as is
+        :param cache_top: keep the top of the stack in the D register
+        :param fast_frames: use the faster calling convention of CodeWriter
+        :return:
+        Returns the CodeWriter used for the translation
+        """
+        writer = StackCachingCodeWriter if cache_top else CodeWriter
         if os.path.isfile(path):
             if path.endswith(".vm"):
                 vm_file = path.split("/")[-1]
                 file = vm_file[0 :vm_file.find(".")] + ".asm"
                 new_file = os.path.join(os.path.dirname(path), file)
-                c = CodeWriter(new_file)
-                Driver.start(path, c, False)
+                c = writer(new_file, trampolines, shared_comparisons, peephole, fast_frames)
+                c.write_routines()
+                Driver.start(path, c, False, optimizer)
             else:
                 raise Exception("Filename should end with .vm")
         elif os.path.isdir(path):
@@ -641,52 +1107,80 @@ class Driver:
                     file_path = os.path.join(path, filename)
                     files.append(file_path)
             new_file = os.path.join(path, path.split('/')[-1] + ".asm")
-            c = CodeWriter(new_file)
+            c = writer(new_file, trampolines, shared_comparisons, peephole, fast_frames)
             c.write_init()
+            c.write_routines()
             for i in range(0, len(files)):
                 call_to_sysinit = False
                 if i == 0:
                     call_to_sysinit = True
-                Driver.start(files[i], c, call_to_sysinit)
+                Driver.start(files[i], c, call_to_sysinit, optimizer)
         else:
             raise Exception("Not a valid file/path")
+        c.close()
+        return c
 
     @staticmethod
-    def start(file_name, c, call_to_sysinit):
-        func_incr = 0 # required for recursive functions
+    def start(file_name, c, call_to_sysinit, optimizer=None):
         p = Parser(file_name, call_to_sysinit)
-        while p.has_more_commands():
-            p.advance()
-            if p.command_type() == Parser.C_PUSH or p.command_type() == Parser.C_POP:
-                command = [p.command_type(), p.arg1(), p.arg2(), file_name]
-                c.write_pushpop(','.join(command))
-            elif p.command_type() == Parser.C_ARITHMETIC:
-                command = [p.command_type(), p.arg1()]
-                c.write_arithmetic(','.join(command))
-            elif p.command_type() == Parser.C_LABEL:
-                command = [p.command_type(), p.arg1()]
-                c.write_label(','.join(command))
-            elif p.command_type() == Parser.C_GOTO:
-                command = [p.command_type(), p.arg1()]
-                c.write_goto(','.join(command))
-            elif p.command_type() == Parser.C_IF:
-                command = [p.command_type(), p.arg1()]
-                c.write_if(','.join(command))
-            elif p.command_type() == Parser.C_CALL:
-                c.write_call(p.arg1() + "," + str(func_incr), p.arg2())
-                func_incr += 1
-            elif p.command_type() == Parser.C_FUNCTION:
-                c.write_function(p.arg1(), p.arg2())
-            elif p.command_type() == Parser.C_RETURN:
+        commands = p.commands()
+        if optimizer is not None:
+            commands = optimizer.optimize(list(commands))
+        for command in commands:
+            if command.type == Parser.C_PUSH or command.type == Parser.C_POP:
+                c.write_pushpop(command)
+            elif command.type == Parser.C_ARITHMETIC:
+                c.write_arithmetic(command)
+            elif command.type == Parser.C_LABEL:
+                c.write_label(command)
+            elif command.type == Parser.C_GOTO:
+                c.write_goto(command)
+            elif command.type == Parser.C_IF or command.type == Parser.C_IF_NOT:
+                c.write_if(command)
+            elif command.type == Parser.C_CALL:
+                c.write_call(command)
+            elif command.type == Parser.C_FUNCTION:
+                c.write_function(command)
+            elif command.type == Parser.C_RETURN:
                 c.write_return()
-            elif p.command_type() == Parser.IGNORE:
-                pass
             else:
                 raise Exception("Invalid syntax")
         c.set_end()
 
+    @staticmethod
+    def main(argv=None):
+        """
+        Command line interface
+        :return:
+        """
+        parser = argparse.ArgumentParser(description="Translates VM code to Hack assembly")
+        parser.add_argument("path", help=".vm file or directory of .vm files")
+        parser.add_argument("--stats", action="store_true", help="report the assembly cache hit rate")
+        parser.add_argument("--trampolines", action="store_true",
+                            help="emit one shared call and return routine instead of inlining them at every site")
+        parser.add_argument("--shared-comparisons", action="store_true",
+                            help="emit one shared eq, lt and gt routine instead of inlining them at every site")
+        parser.add_argument("--peephole", action="store_true", help="optimize the generated assembly")
+        parser.add_argument("-O", "--optimize", action="store_true", help="optimize the VM commands before translation")
+        parser.add_argument("--cache-top", action="store_true", help="keep the top of the stack in the D register")
+        parser.add_argument("--fast-frames", action="store_true",
+                            help="unroll local initialization and save/restore frames with pointer walks")
+        args = parser.parse_args(argv)
+        optimizer = Optimizer() if args.optimize else None
+        c = Driver.check_dir(args.path, args.trampolines, args.shared_comparisons, args.peephole, optimizer,
+                             args.cache_top, args.fast_frames)
+        if args.stats:
+            stats = c.cache_stats()
+            sys.stderr.write("cache: {h} hits, {m} misses, {s} entries, {r:.1%} hit rate\n".format(
+                h=stats["hits"], m=stats["misses"], s=stats["size"], r=stats["hit_rate"]))
+            if c.peephole is not None:
+                sys.stderr.write("peephole: {r} instructions removed\n".format(r=c.peephole.removed))
+            if optimizer is not None:
+                sys.stderr.write("optimizer: {e} VM commands eliminated\n".format(e=optimizer.eliminated))
+
+
 if __name__ == '__main__':
     """
     Entry point of program for execution
     """
-    Driver.check_dir()
+    Driver.main()